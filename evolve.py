@@ -5,12 +5,19 @@ import sys
 import os
 import multiprocessing
 import re
-import pickle
+import json
 
 from src.genetics import Genome
+from src.arraygenome import ArrayGenome, from_genome
 from src.agents import Agent
-from src.physics import World
-from src.graphics import Display
+from src.physics import World, FRICTION_COEFFICIENT
+from src.fitness import FitnessCache
+from src.workers import ScoringPool, SharedPopulation
+from src.evaluation import Evaluation, advance_together
+from src import genefile
+from src.runlog import RunLog
+from src import profiling
+from src import trajectory
 
 display_width = 1200
 display_height = 700
@@ -26,79 +33,386 @@ evaluation_time = 20
 rule_count = 200
 material_count = 5
 input_count = 4
+genome_representation = "list"
 
 max_cell_count = 30
 pacemaker_period = 1.0
 
+physics_engine = "object"
+batch_scoring = 0
+batch_cppn = 0
+
+integrator = "euler"
+ground_contact = "reintegrate"
+contact_friction = FRICTION_COEFFICIENT
+implicit_weight = 1.0
+
+sleeping = 0
+sleep_window = 0.5
+sleep_speed = 0.05
+sleep_force = 0.5
+sleep_voltage = 0.05
+
+early_stopping = 0
+stall_window = 2.0
+speed_margin = 2.0
+
+periodic_extrapolation = 0
+periodic_tolerance = 0.01
+validate_extrapolation = 0
+
+successive_halving = 0
+halving_budgets = [0.25, 0.5]
+halving_cull_fraction = 0.5
+
+shared_population = 0
+
+fitness_cache_size = 1000
+fitness_cache_file_name = None
+
 input_file_name = None
 output_file_name = None
+population_format = "binary"
+run_log_file_name = None
+snapshot_interval = 10
 
-def score_genome(genome):
-    agent = Agent(genome, grid_size, 
-            max_cell_count, pacemaker_period)
-    agent.translate([0, grid_size/2+1])
+profile_file_name = None
+worker_profile_file_name = None
+
+record_demos = 0
+trajectory_file_name = None
+headless = 0
+
+# restored by configure before each configuration is read
+defaults = dict([[name, value] for name, value in globals().items() \
+        if not name.startswith("__") \
+        and (isinstance(value, (int, float, str, list)) or value == None)])
+
+grid_size = max_cell_count/2
+fitness_cache = None
+population_buffer = None
+scoring_pool = None
+
+def create_genome():
+    if genome_representation == "array":
+        return ArrayGenome(rule_count, material_count, input_count)
+    return Genome(rule_count, material_count, input_count)
+
+def represent(genome):
+    if genome_representation == "array" and isinstance(genome, Genome):
+        return from_genome(genome)
+    elif genome_representation == "list" and isinstance(genome, ArrayGenome):
+        return genome.to_genome()
+    return genome
+
+def reference_physics():
+    return integrator == "euler" and ground_contact == "reintegrate"
+
+def create_array_world():
+    from src.arrayphysics import ArrayWorld
+    return ArrayWorld(delta_t, integrator, ground_contact, contact_friction, 
+            implicit_weight)
+
+# The alternative integrators are only implemented by the numpy engine.
+def create_world():
+    if physics_engine == "numpy" or not reference_physics():
+        return create_array_world()
     world = World(delta_t)
-    world.add_agent(agent)
+    if sleeping:
+        world.allow_sleeping(sleep_window, sleep_speed, sleep_force, 
+                sleep_voltage)
+    return world
+
+def sleeping_fraction(evaluation):
+    if not isinstance(evaluation.world, World) \
+            or evaluation.world.sleep_window == None:
+        return None
+    return evaluation.world.sleeping_fraction()
+
+def create_evaluation(genome, world=None):
+    if world == None:
+        world = create_world()
+    return Evaluation(genome, world, grid_size, max_cell_count, 
+            pacemaker_period, evaluation_time, batch_cppn)
+
+def start_evaluation(genome, threshold=None):
+    evaluation = create_evaluation(genome)
+    if record_demos:
+        evaluation.record(0.05)
+    if early_stopping and threshold != None:
+        evaluation.stop_below(threshold, stall_window, speed_margin)
+    if periodic_extrapolation:
+        evaluation.extrapolate_periodic(pacemaker_period, 
+                periodic_tolerance, validate_extrapolation)
+    return evaluation
+
+def evaluate_genome(genome, threshold=None):
+    evaluation = start_evaluation(genome, threshold)
+    evaluation.advance()
+    genome.score = evaluation.score()
+    return evaluation
+
+def score_genome(genome, threshold=None):
+    return evaluate_genome(genome, threshold).score()
+
+def score_batch(genomes):
+    world = create_array_world()
+    evaluations = [create_evaluation(genome, world) for genome in genomes]
+    if record_demos:
+        for evaluation in evaluations:
+            evaluation.record(0.05)
+    advance_together(evaluations)
+
+    for genome, evaluation in zip(genomes, evaluations):
+        genome.score = evaluation.score()
+    return evaluations
+
+# Only complete evaluations scoring at least record_above are recorded,
+# since a genome cut short or scoring below a known score cannot be the
+# champion.
+def recording(evaluation, record_above=None):
+    if not evaluation.complete() \
+            or record_above != None and evaluation.score() < record_above:
+        return None
+    return evaluation.trajectory()
+
+# Returns [score, agent-steps simulated, whether the evaluation ran to
+# completion, extrapolation error or None, fraction of cell-steps skipped
+# by sleeping or None, recorded trajectory or None] for each [genome, 
+# threshold, record_above] item.
+def score_group(items):
+    if batch_scoring:
+        evaluations = score_batch([genome for genome, _, _ in items])
+        return [[evaluation.score(), full_step_count(), True, None, None, 
+                recording(evaluation, item[2])] \
+                for evaluation, item in zip(evaluations, items)]
+    results = []
+    for genome, threshold, record_above in items:
+        evaluation = evaluate_genome(genome, threshold)
+        results.append([genome.score, evaluation.step_count, 
+                evaluation.complete(), evaluation.extrapolation_error(), 
+                sleeping_fraction(evaluation), 
+                recording(evaluation, record_above)])
+    return results
+
+# Scores genomes by their index in population_buffer, writing the scores
+# there. Only indices and the step counts of the results, and the few
+# trajectories wanted, are pickled.
+def score_shared(items):
+    genomes = []
+    for j, threshold, record_above in items:
+        # scores do not depend on the representation, and array genomes
+        # are the cheapest to decode
+        genome = ArrayGenome(rule_count, material_count, input_count)
+        genome.read_record(population_buffer.get(j))
+        genomes.append([genome, threshold, record_above])
+    results = score_group(genomes)
+    for (j, _, _), result in zip(items, results):
+        population_buffer.scores[j] = result[0]
+    return [result[1:] for result in results]
+
+# Finished evaluations drop their recording unless it is wanted, so it is
+# not sent back with them.
+def advance_group(items):
+    evaluations = []
+    for genome, evaluation, threshold, record_above, time_limit in items:
+        if evaluation == None:
+            evaluation = start_evaluation(genome, threshold)
+        evaluation.advance(time_limit)
+        if evaluation.stopped or evaluation.complete() \
+                and recording(evaluation, record_above) == None:
+            evaluation.recorder = None
+        evaluations.append(evaluation)
+    return evaluations
+
+# Successive halving: every genome is simulated for the first budget
+# (a fraction of evaluation_time), the lowest scoring halving_cull_fraction
+# are dropped with their provisional scores, and the rest continue from
+# their saved state to the next budget, up to the full evaluation_time.
+def race(genomes, pending, thresholds, record_above):
+    budgets = [b*evaluation_time for b in halving_budgets \
+            if b < 1] + [evaluation_time]
+    live = dict([[j, None] for j in pending])
+    results = {}
+    for time_limit in budgets:
+        evaluations = scoring_pool.map(advance_group, [[j, [genomes[j], 
+                live[j], thresholds[j], record_above, time_limit]] \
+                for j in live])
+        ranked = []
+        for j, evaluation in evaluations.iteritems():
+            score = evaluation.score()
+            results[j] = [score, evaluation.step_count, 
+                    evaluation.complete(), evaluation.extrapolation_error(), 
+                    sleeping_fraction(evaluation), 
+                    recording(evaluation, record_above)]
+            if evaluation.stopped or evaluation.complete():
+                del live[j]
+            else:
+                live[j] = evaluation
+                ranked.append([score, j])
 
-    x_start = agent.center_of_mass()[0]
+        ranked.sort(reverse=True)
+        survivor_count = max(1, 
+                int(math.ceil(len(ranked)*(1-halving_cull_fraction))))
+        for _, j in ranked[survivor_count:]:
+            del live[j]
+        if len(live) == 0:
+            break
+    return results
 
+def full_step_count():
     sim_timer = 0.0
+    step_count = 0
     while sim_timer < evaluation_time:
-        world.step()
         sim_timer += delta_t
+        step_count += 1
+    return step_count
 
-    delta_x = agent.center_of_mass()[0] - x_start
-    genome.score = abs(delta_x)
-    genome.score *= 0.5 + 0.5*agent.cell_count/max_cell_count
-    return genome.score
-
-def score_group(genomes, scoring_queue):
-    for j, genome in genomes:
-        s = score_genome(genome)
-        scoring_queue.put([j, s])
-
-def multiprocess_score(genomes):
-    scoring_queue = multiprocessing.Queue()
-    scoring_processes = []
-    for i in xrange(scoring_process_count):
-        group = []
-        for j in xrange(i*agents_per_process, (i+1)*agents_per_process):
-            if j < len(genomes):
-                group.append([j, genomes[j]])
-        process = multiprocessing.Process(target=score_group,
-                args=(group,scoring_queue))
-        process.start()
-        scoring_processes.append(process)
-    for process in scoring_processes:
-        process.join()
-    while not scoring_queue.empty():
-        j, score = scoring_queue.get()
+# Scores every genome, returning [simulated, cut short, agent-steps
+# simulated, agent-steps a full evaluation of each would have taken,
+# extrapolation errors found in validation, fractions of cell-steps
+# skipped by sleeping, dict of recorded trajectories by index in genomes].
+# Genomes stopped early or culled by successive halving keep their partial
+# score and are not cached. The first survivor_count genomes survived the
+# last generation unchanged and are never stopped early, since the weakest
+# of them scores exactly the threshold. Their scores and those found in the
+# fitness cache are known, and only a genome scoring at least the best of
+# them can be the champion, so only such genomes send back a trajectory.
+# Successive halving may cull a survivor with a lower provisional score, so
+# then only the cached scores are known.
+def multiprocess_score(genomes, threshold=None, survivor_count=0):
+    pending = []
+    known = []
+    if not successive_halving:
+        known = [genome.score for genome in genomes[:survivor_count]]
+    for j, genome in enumerate(genomes):
+        score = None
+        if fitness_cache != None:
+            score = fitness_cache.get(genome)
+        if score == None:
+            pending.append(j)
+        else:
+            genome.score = score
+            known.append(score)
+    stats = [len(pending), 0, 0, len(pending)*full_step_count(), [], [], 
+            {}]
+    if len(pending) == 0:
+        return stats
+
+    thresholds = dict([[j, threshold if j >= survivor_count else None] \
+            for j in pending])
+    record_above = max(known) if len(known) > 0 else None
+    if successive_halving:
+        results = race(genomes, pending, thresholds, record_above)
+    elif population_buffer != None:
+        for j in pending:
+            population_buffer.put(j, genefile.encode(genomes[j]))
+        results = scoring_pool.map(score_shared, [[j, [j, thresholds[j], 
+                record_above]] for j in pending], even=batch_scoring)
+        for j in results:
+            results[j] = [population_buffer.scores[j]] + results[j]
+    else:
+        # batched worlds amortize better over one large share per process
+        results = scoring_pool.map(score_group, [[j, [genomes[j], 
+                thresholds[j], record_above]] for j in pending], 
+                even=batch_scoring)
+    for j, (score, step_count, complete, error, skipped, recorded) \
+            in results.iteritems():
         genomes[j].score = score
+        stats[2] += step_count
+        if recorded != None:
+            stats[6][j] = recorded
+        if error != None:
+            stats[4].append(error)
+        if skipped != None:
+            stats[5].append(skipped)
+        if not complete:
+            stats[1] += 1
+        elif fitness_cache != None:
+            fitness_cache.put(genomes[j], score)
+    return stats
 
-def demonstrate(genome, queue):
-    world = World(delta_t)
-    agent = Agent(genome, grid_size, max_cell_count, pacemaker_period)
+# Returns [world, function advancing it by a frame, frame interval] for a
+# champion, replaying its recorded trajectory if there is one, otherwise
+# simulating it.
+def demo_world(genome, recorded=None):
+    if recorded != None:
+        recording = trajectory.Trajectory(recorded)
+        world = trajectory.ReplayWorld(recording)
+        return world, world.step, recording.frame_interval
+    world = create_world()
+    agent = Agent(genome, grid_size, max_cell_count, pacemaker_period, 
+            batch_cppn)
     agent.translate([0, grid_size/2+1])
     world.add_agent(agent)
-    display = Display(world, display_width, display_height)
 
     step_count = int(math.ceil(0.05/delta_t))
-    display_time = time.time()
-    while True:
-        if not queue.empty():
-            while not queue.empty():
-                queue.get()
-            display.kill()
-            return
-
+    def advance():
         for _ in xrange(step_count):
             world.step()
+        world.sync()
+    return world, advance, 0.05
+
+# The demonstration process. It shows the latest [genome, recorded
+# trajectory or None] sent over queue in one window, which stays open
+# between champions, until None is sent.
+def demonstrate(queue):
+    # only the demonstration process needs Tkinter
+    from src.graphics import Display, animate
+    message = queue.get()
+    if message == None:
+        return
+    world, advance, frame_interval = demo_world(*message)
+    display = Display(world, display_width, display_height)
+    while True:
+        animate(display, advance, frame_interval, queue)
+        while not queue.empty():
+            message = queue.get()
+        if message == None:
+            break
+        world, advance, frame_interval = demo_world(*message)
+        display.show(world)
+    display.kill()
+
+# Adds the time since start to phase_times[name], returning the time now.
+def end_phase(phase_times, name, start):
+    now = time.time()
+    phase_times[name] = phase_times.get(name, 0.0) + now - start
+    return now
 
-        display.refresh()
-        current_time = time.time()
-        if current_time - display_time < 0.05:
-            time.sleep(0.05 - current_time + display_time)
-        display_time = current_time
+# One JSON line per generation: the wall time of each phase of the main
+# loop, and for each scoring process its busy and idle time, the time its
+# batches waited in the queue, and the totals of the src.profiling
+# counters (time spent growing agents, evaluating CPPNs and simulating,
+# cell-steps simulated and ground contacts).
+def write_profile(f, generation, best, phase_times, startup=None):
+    workers = []
+    totals = {}
+    for i in xrange(scoring_pool.process_count):
+        worker = dict(scoring_pool.totals[i])
+        profiling.merge(totals, worker)
+        worker["busy"] = scoring_pool.busy_times[i]
+        worker["idle"] = scoring_pool.idle_times[i]
+        worker["queue_wait"] = scoring_pool.wait_times[i]
+        workers.append(worker)
+    record = {
+        "generation": generation,
+        "best": best,
+        "wall": sum(phase_times.values()),
+        "phases": phase_times,
+        "workers": workers,
+        "cell_steps": totals.get("cell_steps", 0),
+        "cell_steps_per_second": 0.0,
+        "ground_contacts": totals.get("ground_contacts", 0),
+        "queue_wait": sum(scoring_pool.wait_times),
+    }
+    if totals.get("simulation", 0) > 0:
+        record["cell_steps_per_second"] = \
+                totals["cell_steps"]/totals["simulation"]
+    if startup != None:
+        record["startup"] = startup
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.flush()
 
 def read_parameters(f):
     for line in f:
@@ -145,77 +459,191 @@ def read_parameters(f):
             elif name == "pacemaker_period":
                 global pacemaker_period
                 pacemaker_period = float(value)
+            elif name == "physics_engine":
+                global physics_engine
+                physics_engine = value
+            elif name == "batch_scoring":
+                global batch_scoring
+                batch_scoring = int(value)
+            elif name == "batch_cppn":
+                global batch_cppn
+                batch_cppn = int(value)
+            elif name == "integrator":
+                global integrator
+                integrator = value
+            elif name == "ground_contact":
+                global ground_contact
+                ground_contact = value
+            elif name == "contact_friction":
+                global contact_friction
+                contact_friction = float(value)
+            elif name == "implicit_weight":
+                global implicit_weight
+                implicit_weight = float(value)
+            elif name == "sleeping":
+                global sleeping
+                sleeping = int(value)
+            elif name == "sleep_window":
+                global sleep_window
+                sleep_window = float(value)
+            elif name == "sleep_speed":
+                global sleep_speed
+                sleep_speed = float(value)
+            elif name == "sleep_force":
+                global sleep_force
+                sleep_force = float(value)
+            elif name == "sleep_voltage":
+                global sleep_voltage
+                sleep_voltage = float(value)
+            elif name == "early_stopping":
+                global early_stopping
+                early_stopping = int(value)
+            elif name == "stall_window":
+                global stall_window
+                stall_window = float(value)
+            elif name == "speed_margin":
+                global speed_margin
+                speed_margin = float(value)
+            elif name == "periodic_extrapolation":
+                global periodic_extrapolation
+                periodic_extrapolation = int(value)
+            elif name == "periodic_tolerance":
+                global periodic_tolerance
+                periodic_tolerance = float(value)
+            elif name == "validate_extrapolation":
+                global validate_extrapolation
+                validate_extrapolation = int(value)
+            elif name == "successive_halving":
+                global successive_halving
+                successive_halving = int(value)
+            elif name == "halving_budgets":
+                global halving_budgets
+                halving_budgets = [float(b) for b in value.split(",")]
+            elif name == "halving_cull_fraction":
+                global halving_cull_fraction
+                halving_cull_fraction = float(value)
+            elif name == "shared_population":
+                global shared_population
+                shared_population = int(value)
+            elif name == "fitness_cache_size":
+                global fitness_cache_size
+                fitness_cache_size = int(value)
+            elif name == "fitness_cache_file":
+                global fitness_cache_file_name
+                fitness_cache_file_name = value
             elif name == "input_file":
                 global input_file_name
                 input_file_name = value
             elif name == "output_file":
                 global output_file_name
                 output_file_name = value
+            elif name == "genome_representation":
+                global genome_representation
+                genome_representation = value
+            elif name == "run_log":
+                global run_log_file_name
+                run_log_file_name = value
+            elif name == "snapshot_interval":
+                global snapshot_interval
+                snapshot_interval = int(value)
+            elif name == "profile_file":
+                global profile_file_name
+                profile_file_name = value
+            elif name == "worker_profile_file":
+                global worker_profile_file_name
+                worker_profile_file_name = value
+            elif name == "record_demos":
+                global record_demos
+                record_demos = int(value)
+            elif name == "trajectory_file":
+                global trajectory_file_name
+                trajectory_file_name = value
+            elif name == "population_format":
+                global population_format
+                population_format = value
+            elif name == "headless":
+                global headless
+                headless = int(value)
 
-if len(sys.argv) == 2:
-    if os.path.isfile(sys.argv[1]):
-        read_parameters(open(sys.argv[1], 'r'))
-    else:
-        print "\"%s\" not found" % sys.argv[1]
-        sys.exit()
-elif len(sys.argv) > 2:
-    print "Usage: python evolve.py [CONFIG_FILE]"
-    sys.exit()
+# Restores the default parameters, then reads config, which is the name of
+# a config file, an open one, or a dict from parameter name to value (as in
+# a config file, or a list for halving_budgets).
+def configure(config=None):
+    globals().update(defaults)
+    if isinstance(config, dict):
+        lines = []
+        for name, value in config.iteritems():
+            if isinstance(value, list):
+                value = ",".join([str(v) for v in value])
+            elif isinstance(value, bool):
+                value = int(value)
+            lines.append("%s = %s" % (name, value))
+        read_parameters(lines)
+    elif isinstance(config, str):
+        read_parameters(open(config, "r"))
+    elif config != None:
+        read_parameters(config)
+    global grid_size
+    grid_size = max_cell_count/2
 
-agents_per_process = \
-        int(math.ceil(1.0*population_size/scoring_process_count))
-grid_size = max_cell_count/2
+# Creates the fitness cache and the scoring processes, with a shared buffer
+# for capacity genomes if shared_population is set. The scoring processes
+# inherit the parameters when they start, so these must not change until
+# stop_scoring.
+def start_scoring(capacity, startup=None):
+    global fitness_cache, population_buffer, scoring_pool
+    # processes a caller never stopped are not left running
+    if scoring_pool != None:
+        stop_scoring()
+    fitness_cache = None
+    if fitness_cache_size > 0:
+        cache_parameters = [delta_t, evaluation_time, max_cell_count, 
+                pacemaker_period]
+        if periodic_extrapolation and not validate_extrapolation:
+            cache_parameters.append(periodic_tolerance)
+        if not reference_physics():
+            cache_parameters += [integrator, ground_contact, 
+                    contact_friction, implicit_weight]
+        elif sleeping and physics_engine == "object":
+            cache_parameters += [sleep_window, sleep_speed, sleep_force, 
+                    sleep_voltage]
+        fitness_cache = FitnessCache(cache_parameters, fitness_cache_size, 
+                fitness_cache_file_name)
+
+    # the scoring processes inherit the shared buffer when they start
+    population_buffer = None
+    if shared_population:
+        population_buffer = SharedPopulation(capacity, 
+                genefile.max_record_size(rule_count, material_count))
+    start = time.time()
+    scoring_pool = ScoringPool(scoring_process_count, 
+            worker_profile_file_name != None)
+    if startup != None:
+        end_phase(startup, "scoring_pool", start)
+
+def stop_scoring():
+    global fitness_cache, population_buffer, scoring_pool
+    scoring_pool.close()
+    if fitness_cache != None:
+        fitness_cache.close()
+    fitness_cache = None
+    population_buffer = None
+    scoring_pool = None
 
-if input_file_name != None and os.path.isfile(input_file_name):
-    input_file = open(input_file_name, 'r')
-    genomes = pickle.load(input_file)
-    input_file.close()
-
-    if len(genomes) > population_size:
-        genomes = genomes[:population_size]
-    elif len(genomes) < population_size:
-        start_size = len(genomes)
-        for i in xrange(len(genomes), population_size):
-            genomes.append(genomes[i%start_size].clone())
-            genomes[i].mutate(mutation_rate)
-else:
-    genomes = [Genome(rule_count, material_count, input_count) \
-            for _ in xrange(population_size)]
-    for genome in genomes:
-        genome.randomize()
-        a = Agent(genome, grid_size, max_cell_count, pacemaker_period)
-        while a.cell_count <= 1:
-            a = Agent(genome, grid_size, max_cell_count, pacemaker_period)
-            genome.randomize()
-
-multiprocess_score(genomes)
-best_genome = None
-demo_queue = multiprocessing.Queue()
-demo_process = None
-
-t0 = time.time()
-generation_count = 0
-while time.time() < t0+run_time:
-    multiprocess_score(genomes)
-    genomes.sort(key=lambda g:-g.score)
-
-    print "generation: %d" % generation_count
-    print "best: %f" % genomes[0].score
-    print ""
-
-    if best_genome == None:
-        best_genome = genomes[0].clone()
-    elif genomes[0].score > best_genome.score:
-        best_genome = genomes[0].clone()
-
-    if demo_process != None:
-        demo_queue.put("stop")
-        demo_process.join()
-
-    demo_process = multiprocessing.Process(target=demonstrate, 
-            args=(genomes[0], demo_queue))
-    demo_process.start()
+# Scores genomes as configured (see configure), in new scoring processes,
+# setting and returning their scores.
+def score_population(genomes, config=None):
+    configure(config)
+    start_scoring(len(genomes))
+    try:
+        multiprocess_score(genomes)
+    finally:
+        stop_scoring()
+    return [genome.score for genome in genomes]
 
+# Replaces the bottom half of a population sorted by score with mutated
+# clones of the top half, and crosses over neighbouring clones.
+def breed(genomes):
     for i in xrange(population_size/2):
         j = population_size/2 + i
         genomes[j] = genomes[i].clone()
@@ -224,14 +652,186 @@ while time.time() < t0+run_time:
         if random.random() < crossover_rate:
             genomes[i].crossover(genomes[i+1])
 
-    generation_count += 1
+# Evolves a population as configured (see configure) for run_time seconds,
+# returning the best genome found. Unless headless is set, a demonstration
+# window shows the champion of each generation.
+def run_evolution(config=None):
+    configure(config)
+    startup = {}
+    start_scoring(population_size, startup)
+    profile_file = None
+    run_log = None
+    demo_queue = multiprocessing.Queue()
+    demo_process = None
+    # whatever fails, the scoring processes, the demonstration and the
+    # files are shut down, so another run can start in this process
+    try:
+        phase_start = time.time()
 
-    if output_file_name != None:
-        swap_file = open("population.swp", 'w')
-        pickle.dump(genomes, swap_file)
-        os.rename("population.swp", output_file_name)
-        swap_file.close()
+        if profile_file_name != None:
+            profile_file = open(profile_file_name, "a")
 
-if demo_process != None:
-    demo_queue.put("stop")
-    demo_process.join()
+        if run_log_file_name != None:
+            run_log = RunLog(run_log_file_name, snapshot_interval)
+
+        # the run log holds each generation scored and sorted, so a resumed run
+        # goes on with the next generation bred from the last one logged
+        genomes = None
+        generation_count = 0
+        resumed = False
+        if run_log != None and run_log.last_generation() != None:
+            generation_count = run_log.last_generation()
+            genomes = run_log.population(generation_count)
+            resumed = True
+            print "resuming from generation %d" % generation_count
+        elif input_file_name != None and os.path.isfile(input_file_name):
+            genomes = genefile.load(input_file_name)
+
+        if genomes != None:
+            genomes = [represent(genome) for genome in genomes]
+            if len(genomes) > population_size:
+                genomes = genomes[:population_size]
+            elif len(genomes) < population_size:
+                start_size = len(genomes)
+                for i in xrange(len(genomes), population_size):
+                    genomes.append(genomes[i%start_size].clone())
+                    genomes[i].mutate(mutation_rate)
+            if resumed:
+                breed(genomes)
+                generation_count += 1
+        else:
+            genomes = [create_genome() for _ in xrange(population_size)]
+            for genome in genomes:
+                genome.randomize()
+                a = Agent(genome, grid_size, max_cell_count, 
+                        pacemaker_period, batch_cppn)
+                while a.cell_count <= 1:
+                    a = Agent(genome, grid_size, max_cell_count, 
+                            pacemaker_period, batch_cppn)
+                    genome.randomize()
+
+        phase_start = end_phase(startup, "population", phase_start)
+        stats = multiprocess_score(genomes)
+        recorded = dict([[id(genomes[j]), data] \
+                for j, data in stats[6].iteritems()])
+        end_phase(startup, "initial_score", phase_start)
+        best_genome = None
+        champion = None
+
+        t0 = time.time()
+        while time.time() < t0+run_time:
+            # The top half survived the last generation unchanged, so at least
+            # that many genomes score as well as the weakest of them; a genome
+            # which looks unable to reach its score is unlikely to be kept.
+            phase_times = {}
+            phase_start = time.time()
+            threshold = None
+            if early_stopping and generation_count > 0:
+                threshold = genomes[population_size/2-1].score
+            scoring_pool.reset_statistics()
+            stats = multiprocess_score(genomes, threshold, population_size/2)
+            for j, data in stats[6].iteritems():
+                recorded[id(genomes[j])] = data
+            genomes.sort(key=lambda g:-g.score)
+            phase_start = end_phase(phase_times, "score", phase_start)
+
+            print "generation: %d" % generation_count
+            print "best: %f" % genomes[0].score
+            live_rule_count = sum([g.live_rule_count() for g in genomes])
+            print "live rules: %.1f/%d" % (1.0*live_rule_count/len(genomes), 
+                    rule_count)
+            if fitness_cache != None:
+                print "cache hits: %d/%d" % (fitness_cache.hits, 
+                        fitness_cache.lookups)
+                fitness_cache.hits = 0
+                fitness_cache.lookups = 0
+                fitness_cache.sync()
+            print "worker utilization: %s" % " ".join(["%.0f%%" % (100*u) \
+                    for u in scoring_pool.utilization()])
+            print "barrier idle: %.2fs" % sum(scoring_pool.idle_times)
+            if (early_stopping or successive_halving \
+                    or periodic_extrapolation) and stats[3] > 0:
+                print "cut short: %d/%d (%d agent-steps saved, %.0f%%)" \
+                        % (stats[1], stats[0], stats[3] - stats[2], 
+                        100.0 - 100.0*stats[2]/stats[3])
+            if len(stats[4]) > 0:
+                print "extrapolation error: mean %.4f, max %.4f (%d genomes)" \
+                        % (sum(stats[4])/len(stats[4]), max(stats[4]), 
+                        len(stats[4]))
+            if len(stats[5]) > 0:
+                print "cell-steps asleep: mean %.1f%%, max %.1f%%" \
+                        % (100*sum(stats[5])/len(stats[5]), 100*max(stats[5]))
+            print ""
+            phase_start = end_phase(phase_times, "report", phase_start)
+            if run_log != None:
+                run_log.append(generation_count, genomes)
+            phase_start = end_phase(phase_times, "run_log", phase_start)
+
+            if best_genome == None:
+                best_genome = genomes[0].clone()
+            elif genomes[0].score > best_genome.score:
+                best_genome = genomes[0].clone()
+
+            # the demo runs on while the champion is unchanged; a new one
+            # found in the fitness cache was not simulated, so it has no
+            # trajectory
+            if genomes[0] is not champion:
+                champion_trajectory = recorded.get(id(genomes[0]))
+                champion = genomes[0]
+                if not headless and demo_process == None:
+                    demo_process = multiprocessing.Process(target=demonstrate, 
+                            args=(demo_queue,))
+                    demo_process.start()
+                # the window may have been closed
+                if demo_process != None and demo_process.is_alive():
+                    demo_queue.put([genomes[0], champion_trajectory])
+                if champion_trajectory != None:
+                    if trajectory_file_name != None:
+                        trajectory.save(champion_trajectory, "trajectory.swp")
+                        os.rename("trajectory.swp", trajectory_file_name)
+                    if run_log != None:
+                        run_log.append_trajectory(generation_count, 
+                                champion_trajectory)
+            recorded = {}
+            phase_start = end_phase(phase_times, "demo", phase_start)
+
+            breed(genomes)
+            generation_count += 1
+            phase_start = end_phase(phase_times, "breed", phase_start)
+
+            if output_file_name != None:
+                genefile.dump(genomes, "population.swp", population_format)
+                os.rename("population.swp", output_file_name)
+            phase_start = end_phase(phase_times, "output", phase_start)
+
+            if worker_profile_file_name != None \
+                    and scoring_pool.profile_stats != None:
+                scoring_pool.profile_stats.dump_stats(worker_profile_file_name)
+                end_phase(phase_times, "worker_profile", phase_start)
+            if profile_file != None:
+                write_profile(profile_file, generation_count-1, 
+                        genomes[0].score, phase_times, startup)
+                startup = None
+
+        return best_genome
+    finally:
+        if demo_process != None:
+            if demo_process.is_alive():
+                demo_queue.put(None)
+            demo_process.join()
+            # messages a closed window never read are dropped
+            demo_queue.cancel_join_thread()
+        stop_scoring()
+        if profile_file != None:
+            profile_file.close()
+        if run_log != None:
+            run_log.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print "Usage: python evolve.py [CONFIG_FILE]"
+        sys.exit()
+    elif len(sys.argv) == 2 and not os.path.isfile(sys.argv[1]):
+        print "\"%s\" not found" % sys.argv[1]
+        sys.exit()
+    run_evolution(sys.argv[1] if len(sys.argv) == 2 else None)
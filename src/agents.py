@@ -1,6 +1,15 @@
-from physics import Cell, g
+import collections
+import time
+
+from physics import Cell, g, interact_edges, BEND_OFFSETS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 EAST, NORTH, WEST, SOUTH = 0, 1, 2, 3
+CPPN_TILE = 8
 
 def transform_properties(before):
     after = []
@@ -22,16 +31,31 @@ def transform_properties(before):
 
     return after
 
+# A material's Cell constructor arguments, after mass and position
+property_order = ["axial_stiffness", "bending_stiffness", "expansion",
+        "dissipation", "activation_rate", "transmittivity",
+        "contact_response"]
+
+def cell_arguments(material):
+    values = dict(transform_properties(material))
+    return [values[name] for name in property_order]
+
+# Grows an agent from its genome breadth first, from a pacemaker at the
+# center of a grid_size x grid_size grid. Only occupied and queued positions
+# are stored, and CPPN results are memoized on the genome by grid position
+# and adjacent count, so growth takes time linear in the number of cells.
 class Agent:
     def __init__(self, genome, grid_size, max_cell_count, 
-            pacemaker_period):
+            pacemaker_period, batch_cppn=False):
         self.grid_size = grid_size
-        self.grid = [[False]*grid_size for _ in xrange(grid_size)]
+        # cells by grid position, and the positions queued in the frontier
+        self.grid = {}
+        self.queued = set()
         i_center = grid_size/2
         j_center = grid_size/2
 
         self.cells = []
-        self.frontier = []
+        self.frontier = collections.deque()
         self.cell_count = 0
 
         self.pacemaker = Cell(1.0, [0.0, 0.0], 10, 15, 
@@ -40,59 +64,126 @@ class Agent:
         self.pacemaker_timer = 0.0
         self.add_cell(self.pacemaker, i_center, j_center)
 
+        materials = [cell_arguments(m) for m in genome.materials]
+        if genome.growth_cache is None:
+            genome.growth_cache = {}
+        cache = genome.growth_cache
+        # seconds spent evaluating the CPPN, and the number of evaluations
+        self.cppn_time = 0.0
+        self.cppn_count = 0
+
+        # batched CPPN results by tile
+        cppn_tiles = {}
+
         while len(self.frontier) > 0 and self.cell_count < max_cell_count:
-            i, j = self.frontier.pop(0)
+            i, j = self.frontier.popleft()
             x = 1.0*(j - j_center)
             y = 1.0*(i_center - i)
-            r = (x**2 + y**2)**0.5
-            adjacent_count = 0
-            for i_p, j_p in self.adjacent_indices(i, j):
-                adjacent = self.grid[i_p][j_p]
-                if isinstance(adjacent, Cell):
-                    adjacent_count += 1
-
-            x_in = x/grid_size + 0.5
-            y_in = y/grid_size + 0.5
-            r_in = 1.414*(x**2 + y**2)**0.5/grid_size
-            adj_in = (adjacent_count - 1)/3.0
-
-            growth, properties = genome.cppn([x_in, y_in, r_in, adj_in])
+            adjacent_count = self.adjacent_count(i, j)
+
+            key = (grid_size, i, j, adjacent_count)
+            if key in cache:
+                growth, material_index = cache[key]
+            elif batch_cppn:
+                tile = (i/CPPN_TILE, j/CPPN_TILE)
+                if tile not in cppn_tiles:
+                    start = time.time()
+                    cppn_tiles[tile] = self.evaluate_tile(genome, i, j)
+                    self.cppn_time += time.time() - start
+                    self.cppn_count += CPPN_TILE*CPPN_TILE*4
+                growth, material_index = cppn_tiles[tile]
+                k = (i % CPPN_TILE, j % CPPN_TILE, adjacent_count-1)
+                growth = float(growth[k])
+                material_index = int(material_index[k])
+            else:
+                start = time.time()
+                growth, material_index = genome.cppn_index(
+                        self.cppn_inputs(i, j, adjacent_count))
+                self.cppn_time += time.time() - start
+                self.cppn_count += 1
+            cache[key] = (growth, material_index)
+
+            self.queued.remove((i, j))
             if growth > (1.0 - 1.0*self.cell_count/max_cell_count)**2:
-                self.grid[i][j] = False
                 continue
-            properties = transform_properties(properties)
-            for p in properties:
-                if p[0] == "axial_stiffness":
-                    axial_stiffness = p[1]
-                elif p[0] == "bending_stiffness":
-                    bending_stiffness = p[1]
-                elif p[0] == "expansion":
-                    expansion = p[1]
-                elif p[0] == "dissipation":
-                    dissipation = p[1]
-                elif p[0] == "activation_rate":
-                    activation_rate = p[1]
-                elif p[0] == "transmittivity":
-                    transmittivity = p[1]
-                elif p[0] == "contact_response":
-                    contact_response = p[1]
-
-            cell = Cell(1.0, [x, y], axial_stiffness, 
-                    bending_stiffness, expansion, dissipation, 
-                    activation_rate, transmittivity, contact_response)
+            cell = Cell(1.0, [x, y], *materials[material_index])
             self.add_cell(cell, i, j)
 
+        self.build_edges()
+
+    # For interact_edges: each connection once, as [cell, slot, other
+    # cell, other cell's slot], and for each cell its connected slots, each
+    # with the other connected slots and their rest angle offsets.
+    def build_edges(self):
+        self.edges = []
+        self.bend_pairs = []
+        for cell in self.cells:
+            slots = [i for i in xrange(4) if cell.connections[i]]
+            for i in slots:
+                if i in [EAST, NORTH]:
+                    self.edges.append([cell, i, cell.connections[i], 
+                            (i+2) % 4])
+            self.bend_pairs.append([[i, [[j, BEND_OFFSETS[(j-i) % 4]] \
+                    for j in slots if j != i]] for i in slots])
+
+    def adjacent_count(self, i, j):
+        adjacent_count = 0
+        for position in self.adjacent_indices(i, j):
+            if position in self.grid:
+                adjacent_count += 1
+        return adjacent_count
+
+    def cppn_inputs(self, i, j, adjacent_count):
+        grid_size = self.grid_size
+        x = 1.0*(j - grid_size/2)
+        y = 1.0*(grid_size/2 - i)
+
+        x_in = x/grid_size + 0.5
+        y_in = y/grid_size + 0.5
+        r_in = 1.414*(x**2 + y**2)**0.5/grid_size
+        adj_in = (adjacent_count - 1)/3.0
+        return [x_in, y_in, r_in, adj_in]
+
+    # Evaluates the CPPN in one batch for every position of the
+    # CPPN_TILE x CPPN_TILE block of the grid containing (i, j), for each
+    # adjacent count a frontier position can have. Inputs are computed as
+    # in cppn_inputs, so results are identical to per-cell evaluation.
+    def evaluate_tile(self, genome, i, j):
+        i_start = i - i % CPPN_TILE
+        j_start = j - j % CPPN_TILE
+        grid_size = self.grid_size
+        shape = (CPPN_TILE, CPPN_TILE, 4)
+        i_p = i_start + numpy.arange(CPPN_TILE)[:, None, None]
+        j_p = j_start + numpy.arange(CPPN_TILE)[None, :, None]
+        a = numpy.arange(1, 5)[None, None, :]
+
+        x = numpy.broadcast_to(1.0*(j_p - grid_size/2), shape)
+        y = numpy.broadcast_to(1.0*(grid_size/2 - i_p), shape)
+        inputs = numpy.empty(shape + (4,))
+        inputs[..., 0] = x/grid_size + 0.5
+        inputs[..., 1] = y/grid_size + 0.5
+        # array exponents keep numpy on pow(), matching x**2 and **0.5
+        square = numpy.power(x, numpy.full(shape, 2.0)) \
+                + numpy.power(y, numpy.full(shape, 2.0))
+        inputs[..., 2] = 1.414*numpy.power(square, numpy.full(shape, 0.5)) \
+                / grid_size
+        inputs[..., 3] = numpy.broadcast_to((a - 1)/3.0, shape)
+
+        growth, material_index = genome.cppn_batch(inputs.reshape(-1, 4))
+        return growth.reshape(shape), material_index.reshape(shape)
+
     def add_cell(self, cell, i, j):
         self.cells.append(cell)
         self.cell_count += 1
-        self.grid[i][j] = cell
+        self.grid[(i, j)] = cell
 
         for i_p, j_p in self.adjacent_indices(i, j):
-            adj = self.grid[i_p][j_p]
-            if adj == False:
-                self.grid[i_p][j_p] = True
-                self.frontier.append([i_p, j_p])
-            elif isinstance(adj, Cell):
+            adj = self.grid.get((i_p, j_p))
+            if adj == None:
+                if (i_p, j_p) not in self.queued:
+                    self.queued.add((i_p, j_p))
+                    self.frontier.append((i_p, j_p))
+            else:
                 if j_p > j:
                     direction = EAST
                     opposite = WEST
@@ -119,7 +210,7 @@ class Agent:
             elif j_p < 0 or j_p >= self.grid_size:
                 continue
             else:
-                adjacent.append([i_p, j_p])
+                adjacent.append((i_p, j_p))
 
         return adjacent
 
@@ -127,8 +218,7 @@ class Agent:
         if self.pacemaker_timer >= self.pacemaker_period:
             self.pacemaker.voltage = 0.21
             self.pacemaker_timer %= self.pacemaker_period
-        for c in self.cells:
-            c.interact(delta_t)
+        interact_edges(self.cells, self.edges, self.bend_pairs, delta_t)
         self.pacemaker_timer += delta_t
 
     def translate(self, delta_position):
@@ -0,0 +1,252 @@
+import array
+import random
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import genefile
+from genefile import NONE, RULE, CONSTANT, INPUT
+from genetics import Genome, rules, properties, compile_rules
+
+opcode_range = range(len(rules))
+
+# A Genome stored in a few typed arrays rather than nested lists: per rule
+# an opcode (its index in genetics.rules), and per argument slot, two per
+# rule, a kind, an index (of a rule or an input) and a constant. Material
+# values are one row per material. Random numbers are drawn in the same
+# order as Genome, so the two evolve identically from the same seed, and
+# rules and materials give the list form for code which reads it.
+class ArrayGenome:
+    def __init__(self, rule_count, material_count, input_count):
+        self.rule_count = rule_count
+        self.material_count = material_count
+        self.input_count = input_count
+        self.score = 0.0
+        self.ops = array.array("B", [0])*rule_count
+        self.kinds = array.array("B", [NONE])*(2*rule_count)
+        self.indices = array.array("H", [0])*(2*rule_count)
+        self.constants = array.array("d", [0.0])*(2*rule_count)
+        self.values = array.array("d", [0.0]) \
+                *(material_count*len(properties))
+        self.changed()
+
+    def changed(self):
+        self.evaluator = None
+        self.batch_evaluator = None
+        self.live = None
+        self.material_lists = None
+        self.growth_cache = None
+
+    def __getstate__(self):
+        return [self.rule_count, self.material_count, self.input_count,
+                self.record()]
+
+    def __setstate__(self, state):
+        rule_count, material_count, input_count, record = state
+        self.__init__(rule_count, material_count, input_count)
+        self.read_record(record)
+
+    @property
+    def rules(self):
+        rule_list = []
+        for i in xrange(self.rule_count):
+            rule = [rules[self.ops[i]][0]]
+            for k in xrange(2*i, 2*i+2):
+                kind = self.kinds[k]
+                if kind == CONSTANT:
+                    rule.append(["constant", self.constants[k]])
+                elif kind != NONE:
+                    rule.append([genefile.tag_names[kind], self.indices[k]])
+            rule_list.append(rule)
+        return rule_list
+
+    # Built once per change; editing the returned lists has no effect.
+    @property
+    def materials(self):
+        if self.material_lists is None:
+            size = len(properties)
+            self.material_lists = [[[p, v] for p, v in zip(properties,
+                    self.values[i*size:(i+1)*size])] \
+                    for i in xrange(self.material_count)]
+        return self.material_lists
+
+    def cppn(self, inputs):
+        growth, material_index = self.cppn_index(inputs)
+        return growth, self.materials[material_index]
+
+    def cppn_index(self, inputs):
+        if self.evaluator is None:
+            self.evaluator = compile_rules(self.rules,
+                    self.material_count+1, self.liveness())
+        outputs = self.evaluator(inputs)
+        material_index = max(range(self.material_count),
+                key=lambda x:outputs[x+1])
+        return outputs[0], material_index
+
+    def cppn_batch(self, inputs):
+        if self.batch_evaluator is None:
+            self.batch_evaluator = compile_rules(self.rules,
+                    self.material_count+1, self.liveness(), True)
+        outputs = self.batch_evaluator(numpy.asarray(inputs, dtype=float))
+        outputs = numpy.array(numpy.broadcast_arrays(*outputs))
+        return outputs[0], numpy.argmax(outputs[1:], 0)
+
+    interpret = Genome.interpret.im_func
+
+    def __str__(self):
+        return str(self.to_genome())
+
+    def liveness(self):
+        if self.live is None:
+            first_output = self.rule_count - (self.material_count+1)
+            self.live = [False]*self.rule_count
+            for i in xrange(self.rule_count-1, -1, -1):
+                if i >= first_output:
+                    self.live[i] = True
+                if self.live[i]:
+                    for k in xrange(2*i, 2*i+2):
+                        if self.kinds[k] == RULE:
+                            self.live[self.indices[k]] = True
+        return self.live
+
+    def live_rule_count(self):
+        return sum(self.liveness())
+
+    def randomize(self):
+        for i in xrange(self.rule_count):
+            self.randomize_rule(i)
+        for i in xrange(len(self.values)):
+            self.values[i] = random.random()
+        self.changed()
+
+    def randomize_rule(self, index):
+        op = random.choice(opcode_range)
+        self.ops[index] = op
+        self.kinds[2*index+1] = NONE
+        self.indices[2*index+1] = 0
+        self.constants[2*index+1] = 0.0
+        for j in xrange(rules[op][1]):
+            self.randomize_argument(index, 2*index+j,
+                    True if j>0 else False)
+
+    def randomize_argument(self, index, slot, allow_constant):
+        self.indices[slot] = 0
+        self.constants[slot] = 0.0
+        if random.random() < 1.0*index/self.rule_count:
+            self.kinds[slot] = RULE
+            self.indices[slot] = random.randint(0, index-1)
+        elif allow_constant and random.random() < 0.5:
+            self.kinds[slot] = CONSTANT
+            self.constants[slot] = random.random()*4-2
+        else:
+            self.kinds[slot] = INPUT
+            self.indices[slot] = random.randint(0, self.input_count-1)
+
+    def mutate(self, r):
+        for i in xrange(self.rule_count):
+            rand = random.random()
+            if rand < r/2:
+                self.randomize_rule(i)
+            elif rand < r:
+                j = random.randint(1, rules[self.ops[i]][1])
+                self.randomize_argument(i, 2*i+j-1, True)
+
+        size = len(properties)
+        for i in xrange(self.material_count):
+            rand = random.random()
+            if rand < r/2:
+                for k in xrange(i*size, (i+1)*size):
+                    self.values[k] = random.random()
+            else:
+                j = random.randint(0, size-1)
+                self.values[i*size+j] = random.random()
+        self.changed()
+
+    def crossover(self, other):
+        i = random.randint(0, self.rule_count)
+        j = random.randint(0, self.rule_count)
+        if j < i:
+            i, j = j, i
+        swap(self.ops, other.ops, i, j)
+        for name in ["kinds", "indices", "constants"]:
+            swap(getattr(self, name), getattr(other, name), 2*i, 2*j)
+
+        i = random.randint(0, self.material_count)
+        j = random.randint(0, self.material_count)
+        if j < i:
+            i, j = j, i
+        size = len(properties)
+        swap(self.values, other.values, i*size, j*size)
+        self.changed()
+        other.changed()
+
+    def clone(self):
+        g = ArrayGenome(0, 0, self.input_count)
+        g.rule_count = self.rule_count
+        g.material_count = self.material_count
+        g.score = self.score
+        g.ops = self.ops[:]
+        g.kinds = self.kinds[:]
+        g.indices = self.indices[:]
+        g.constants = self.constants[:]
+        g.values = self.values[:]
+        return g
+
+    # The genefile record of this genome, whose constants are pooled.
+    def record(self):
+        indices = self.indices[:]
+        constants = array.array("d")
+        for k, kind in enumerate(self.kinds):
+            if kind == CONSTANT:
+                indices[k] = len(constants)
+                constants.append(self.constants[k])
+        words = [indices, self.values[:], constants]
+        if sys.byteorder != "little":
+            for a in words:
+                a.byteswap()
+        return "".join([struct.pack("<d", self.score), self.ops.tostring(),
+            self.kinds.tostring(), words[0].tostring(), words[1].tostring(),
+            struct.pack("<H", len(constants)), words[2].tostring()])
+
+    def read_record(self, data, position=0):
+        def take(code, count):
+            end = position + count*array.array(code).itemsize
+            return genefile.decode_array(code, data[position:end]), end
+
+        self.score = struct.unpack_from("<d", data, position)[0]
+        position += 8
+        self.ops, position = take("B", self.rule_count)
+        self.kinds, position = take("B", 2*self.rule_count)
+        self.indices, position = take("H", 2*self.rule_count)
+        self.values, position = take("d",
+                self.material_count*len(properties))
+        constant_count = struct.unpack_from("<H", data, position)[0]
+        position += 2
+        pool, position = take("d", constant_count)
+        for k, kind in enumerate(self.kinds):
+            if kind == CONSTANT:
+                self.constants[k] = pool[self.indices[k]]
+                self.indices[k] = 0
+        self.changed()
+
+    def to_genome(self):
+        g = Genome(self.rule_count, self.material_count, self.input_count)
+        g.rules = self.rules
+        g.materials = [[p[:] for p in m] for m in self.materials]
+        g.score = self.score
+        return g
+
+def swap(a, b, i, j):
+    temp = a[i:j]
+    a[i:j] = b[i:j]
+    b[i:j] = temp
+
+def from_genome(genome):
+    g = ArrayGenome(genome.rule_count, genome.material_count,
+            genome.input_count)
+    g.read_record(genefile.encode(genome))
+    return g
@@ -0,0 +1,379 @@
+import math
+
+import numpy
+
+import physics
+from physics import g, FRICTION_COEFFICIENT, DAMPING_COEFFICIENT
+
+TWO_PI = 2*math.pi
+
+# Structure-of-arrays counterpart of World. Cell state lives in contiguous
+# arrays while stepping; call sync() to copy it back into the Cell objects
+# (e.g. before drawing or reading Agent.center_of_mass).
+#
+# The update reproduces the object engine operation for operation,
+# including the order in which Cell.interact charges neighbours and the
+# order in which forces are accumulated on each body, so trajectories
+# match World bit for bit (checked on every genome in genes/) with the
+# default integrator and ground contact. The alternatives, for stepping
+# stably at several times the usual delta_t, are:
+#   integrator="implicit": linearly implicit Euler for the axial springs,
+#       the stiffest forces (see implicit_force); bending stays explicit.
+#       implicit_weight below 1 damps oscillations less, but is only
+#       stable for smaller steps.
+#   ground_contact="constraint": bodies are projected back onto the ground
+#       and lose their downward velocity, with Coulomb friction limiting
+#       the horizontal velocity change to contact_friction times the
+#       vertical one, instead of re-integrating the step with a counter
+#       force.
+class ArrayWorld:
+    def __init__(self, delta_t, integrator="euler",
+            ground_contact="reintegrate",
+            contact_friction=FRICTION_COEFFICIENT, implicit_weight=1.0):
+        self.delta_t = delta_t
+        self.integrator = integrator
+        self.implicit_weight = implicit_weight
+        self.ground_contact = ground_contact
+        self.contact_friction = contact_friction
+        self.bodies = []
+        self.agents = []
+        self.cells = []
+        self.built = False
+
+    # Agents are simulated independently, so any number of them can be
+    # packed into one world and advanced together by a single step().
+    def add_agent(self, agent):
+        if self.built:
+            self.sync()
+            self.built = False
+        self.agents.append(agent)
+        for c in agent.cells:
+            self.bodies.append(c)
+            self.cells.append(c)
+
+    def build(self):
+        dt = self.delta_t
+        cells = self.cells
+        n = len(cells)
+        index = dict((id(c), k) for k, c in enumerate(cells))
+
+        self.position = numpy.array([c.position for c in cells], dtype=float)
+        self.velocity = numpy.array([c.velocity for c in cells], dtype=float)
+        self.mass = numpy.array([c.mass for c in cells], dtype=float)
+        self.voltage = numpy.array([c.voltage for c in cells], dtype=float)
+        self.phase = numpy.array([c.phase for c in cells], dtype=int)
+        self.contact = numpy.array([bool(c.contact_response) for c in cells])
+        self.decay = numpy.array([1-c.dissipation*dt for c in cells])
+        self.activation_rate = numpy.array(
+                [c.activation_rate for c in cells], dtype=float)
+        self.activation_step = numpy.array(
+                [c.activation_rate*dt for c in cells])
+        self.transmittivity = numpy.array(
+                [c.transmittivity for c in cells], dtype=float)
+        self.gravity = -g*self.mass
+
+        self.pacemakers = numpy.array(
+                [index[id(a.pacemaker)] for a in self.agents], dtype=int)
+        self.pacemaker_timer = numpy.array(
+                [a.pacemaker_timer for a in self.agents], dtype=float)
+        self.pacemaker_period = numpy.array(
+                [a.pacemaker_period for a in self.agents], dtype=float)
+
+        # directed edges (m, slot) -> neighbour, in Cell.interact order
+        neighbours = -numpy.ones((n, 4), dtype=int)
+        src, dst, slot = [], [], []
+        for m, c in enumerate(cells):
+            for i in xrange(4):
+                other = c.connections[i]
+                if other:
+                    neighbours[m, i] = index[id(other)]
+                    src.append(m)
+                    dst.append(index[id(other)])
+                    slot.append(i)
+        src = numpy.array(src, dtype=int)
+        dst = numpy.array(dst, dtype=int)
+        slot = numpy.array(slot, dtype=int)
+        edge_count = len(src)
+        self.src, self.dst, self.slot = src, dst, slot
+
+        # Cell m charges its phase 0 neighbours before computing its own
+        # springs, so the voltage of cell n as seen by cell m includes the
+        # charge from every neighbour of n with index <= m. Charges are
+        # summed in ascending neighbour order, as the object engine does.
+        ordered = numpy.sort(numpy.where(neighbours < 0, n, neighbours), 1)
+        self.ordered_neighbours = ordered
+        self_count = (ordered < numpy.arange(n)[:, None]).sum(1)
+        other_count = (ordered[dst] <= src[:, None]).sum(1)
+        self.self_voltage_index = src*5 + self_count[src]
+        self.other_voltage_index = dst*5 + other_count
+
+        expansion = numpy.array([c.expansion for c in cells], dtype=float)
+        axial = numpy.array([c.axial_stiffness for c in cells], dtype=float)
+        bending = numpy.array(
+                [c.bending_stiffness for c in cells], dtype=float)
+        self.expansion_src = expansion[src]
+        self.expansion_dst = expansion[dst]
+        self.axial_sum = axial[src] + axial[dst]
+        self.bending_src = bending[src]
+
+        # bending terms for each (edge, other slot) pair
+        self.angle_index = src[:, None]*4 + numpy.arange(4)[None, :]
+        self.bend_mask = (neighbours[src] >= 0) \
+                & (numpy.arange(4)[None, :] != slot[:, None])
+        nominal = math.pi*((numpy.arange(4)[None, :]-slot[:, None]) % 4)/2
+        self.bend_nominal = numpy.where(self.bend_mask, nominal, 0.0)
+
+        # Force contributions in the order they are pushed: gravity on every
+        # body, then for each cell its four axial forces followed by the
+        # bending force pairs (neighbour, self) for each slot.
+        order = []
+        targets = []
+        for k in xrange(n):
+            order.append(k)
+            targets.append(k)
+        first = numpy.searchsorted(src, numpy.arange(n+1))
+        for m in xrange(n):
+            for e in xrange(first[m], first[m+1]):
+                order.append(n + e)
+                targets.append(m)
+            for e in xrange(first[m], first[m+1]):
+                order.append(n + edge_count + e)
+                targets.append(dst[e])
+                order.append(n + 2*edge_count + e)
+                targets.append(m)
+        self.force_order = numpy.array(order, dtype=int)
+        self.force_targets = numpy.array(targets, dtype=int)
+        # Array exponents keep numpy on pow() rather than its x*x and sqrt()
+        # shortcuts, which round differently from the object engine's
+        # **2 and **0.5.
+        self.two = numpy.full((edge_count, 2), 2.0)
+        self.half = numpy.full(edge_count, 0.5)
+        self.force_x = numpy.zeros(n + 3*edge_count)
+        self.force_y = numpy.zeros(n + 3*edge_count)
+
+        # Agents are coupled only within themselves, so the implicit solve
+        # is done per agent, over its cells and the edges leaving them.
+        # Each edge's 2x2 Jacobian block is added to its source's diagonal
+        # block of the agent's stiffness matrix and subtracted from the
+        # (source, destination) block; these are the flat matrix indices.
+        ends = numpy.cumsum([len(a.cells) for a in self.agents])
+        starts = ends - numpy.array([len(a.cells) for a in self.agents])
+        self.agent_ranges = []
+        for start, end in zip(starts, ends):
+            size = 2*(end - start)
+            edges = slice(first[start], first[end])
+            rows = 2*(src[edges] - start)[:, None, None] \
+                    + numpy.arange(2)[None, :, None]
+            columns = numpy.arange(2)[None, None, :]
+            diagonal = rows*size + 2*(src[edges] - start)[:, None, None] \
+                    + columns
+            off_diagonal = rows*size \
+                    + 2*(dst[edges] - start)[:, None, None] + columns
+            self.agent_ranges.append([start, end, edges, numpy.concatenate(
+                    [diagonal.ravel(), off_diagonal.ravel()])])
+
+        self.built = True
+
+    def step(self):
+        if not self.built:
+            self.build()
+        dt = self.delta_t
+        n = len(self.cells)
+        src, dst = self.src, self.dst
+        edge_count = len(src)
+        position = self.position
+        voltage = self.voltage
+        phase = self.phase
+
+        # Agent.step: pacemakers
+        fire = self.pacemaker_timer >= self.pacemaker_period
+        if fire.any():
+            voltage[self.pacemakers[fire]] = 0.21
+            self.pacemaker_timer[fire] %= self.pacemaker_period[fire]
+
+        # Cell.interact: charging
+        charge = numpy.where(phase == 1, voltage*self.transmittivity*dt, 0.0)
+        charge = numpy.append(charge, 0.0)[self.ordered_neighbours]
+        charge *= (phase == 0)[:, None]
+        seen = numpy.empty((n, 5))
+        seen[:, 0] = voltage
+        for k in xrange(4):
+            seen[:, k+1] = seen[:, k] + charge[:, k]
+        self.voltage = voltage = seen[:, 4].copy()
+        seen = seen.ravel()
+        self_voltage = seen[self.self_voltage_index]
+        other_voltage = seen[self.other_voltage_index]
+
+        # Cell.interact: edge geometry
+        delta = position[dst] - position[src]
+        delta_x = delta[:, 0]
+        delta_y = delta[:, 1]
+        square = numpy.power(delta, self.two)
+        distance = numpy.power(square[:, 0] + square[:, 1], self.half)
+        angle = numpy.arctan2(delta_y, delta_x)
+
+        # axial forces
+        target = 2.0 + (self.expansion_src*self_voltage \
+                + self.expansion_dst*other_voltage)/2
+        force = self.axial_sum*(distance-target)/2
+        self.springs = [delta, distance, target]
+        force_x = self.force_x
+        force_y = self.force_y
+        force_x[:n] = 0.0
+        force_y[:n] = self.gravity
+        force_x[n:n+edge_count] = force*delta_x/distance
+        force_y[n:n+edge_count] = force*delta_y/distance
+
+        # bending forces
+        angles = numpy.zeros(4*n)
+        angles[self.angle_index[:, 0] + self.slot] = angle
+        others = angles[self.angle_index]
+        wrapped = (others - angle[:, None]) % TWO_PI
+        wrapped = numpy.where(self.bend_mask, wrapped, 0.0)
+        correction = numpy.zeros(edge_count)
+        for j in xrange(4):
+            correction += wrapped[:, j]
+            correction -= self.bend_nominal[:, j]
+        force = self.bending_src*correction/distance
+        bend_x = -force*delta_y/distance
+        bend_y = force*delta_x/distance
+        force_x[n+edge_count:n+2*edge_count] = bend_x
+        force_y[n+edge_count:n+2*edge_count] = bend_y
+        force_x[n+2*edge_count:] = -bend_x
+        force_y[n+2*edge_count:] = -bend_y
+
+        order = self.force_order
+        targets = self.force_targets
+        force = numpy.empty((n, 2))
+        force[:, 0] = numpy.bincount(targets, force_x[order], n)
+        force[:, 1] = numpy.bincount(targets, force_y[order], n)
+
+        self.pacemaker_timer += dt
+
+        # Cell.step: voltage state machine
+        voltage[(position[:, 0] < 0.001) & self.contact & (phase == 0)] = 0.21
+        to_active = (phase == 0) & (voltage > 0.2)
+        to_recovering = (phase == 1) & (voltage > 1)
+        to_resting = (phase == 2) & (voltage < -0.5)
+        phase[to_active] = 1
+        phase[to_recovering] = 2
+        phase[to_resting] = 0
+        self.voltage = numpy.where(phase == 0, voltage*self.decay,
+                numpy.where(phase == 1, voltage + self.activation_step,
+                voltage - self.activation_rate*(voltage/2+0.5)*dt))
+
+        self.integrate(force)
+
+    def integrate(self, force):
+        if self.integrator == "implicit":
+            force = self.implicit_force(force)
+        if self.ground_contact == "constraint":
+            self.integrate_constrained(force)
+        else:
+            self.integrate_reference(force)
+
+    # Linearly implicit (backward) Euler for the axial springs: solves
+    # (M - w dt^2 K) dv = dt (f + w dt K v), where K is the Jacobian of the
+    # spring forces with respect to position and w is implicit_weight, and
+    # returns the force which produces dv in an explicit step. Compressed
+    # springs contribute only their axial stiffness, so that the transverse
+    # term never makes the system softer than the mass matrix alone.
+    def implicit_force(self, force):
+        dt = self.delta_t
+        weight = self.implicit_weight
+        delta, distance, target = self.springs
+        direction = delta/distance[:, None]
+        outer = direction[:, :, None]*direction[:, None, :]
+        stretch = numpy.maximum(0.0, 1 - target/distance)
+        jacobian = (self.axial_sum/2)[:, None, None] \
+                *(outer + stretch[:, None, None]*(numpy.eye(2) - outer))
+
+        change = numpy.empty_like(force)
+        for start, end, edges, indices in self.agent_ranges:
+            size = end - start
+            block = jacobian[edges].ravel()
+            stiffness = numpy.bincount(indices, numpy.concatenate([-block, 
+                    block]), 4*size*size).reshape(2*size, 2*size)
+            mass = numpy.repeat(self.mass[start:end], 2)
+            system = numpy.diag(mass) - weight*dt*dt*stiffness
+            velocity = self.velocity[start:end].ravel()
+            rhs = dt*(force[start:end].ravel() \
+                    + weight*dt*stiffness.dot(velocity))
+            change[start:end] = numpy.linalg.solve(system, 
+                    rhs).reshape(size, 2)
+        return change*self.mass[:, None]/dt
+
+    def integrate_constrained(self, force):
+        dt = self.delta_t
+        position = self.position
+        velocity = self.velocity
+
+        velocity += force*dt/self.mass[:, None]
+        position += velocity*dt
+
+        below = numpy.nonzero(position[:, 1] < 0)[0]
+        physics.ground_contacts += len(below)
+        if len(below):
+            v = velocity[below]
+            position[below, 1] = 0.0
+            impulse = numpy.maximum(0.0, -v[:, 1])
+            v[:, 1] += impulse
+            slip = numpy.minimum(numpy.abs(v[:, 0]), 
+                    self.contact_friction*impulse)
+            v[:, 0] -= numpy.sign(v[:, 0])*slip
+            velocity[below] = v
+
+        velocity *= (1-dt*DAMPING_COEFFICIENT)
+
+    # Body.step, including its ground penetration correction
+    def integrate_reference(self, force):
+        dt = self.delta_t
+        mass = self.mass
+        position = self.position
+        velocity = self.velocity
+
+        velocity += force*dt/mass[:, None]
+        position += velocity*dt
+
+        below = numpy.nonzero(position[:, 1] < 0)[0]
+        physics.ground_contacts += len(below)
+        if len(below):
+            p = position[below]
+            v = velocity[below]
+            f = force[below]
+            m = mass[below]
+            p -= v*dt
+            v -= v*dt
+
+            counter = -(m/dt)*(p[:, 1]/dt + v[:, 1]) - f[:, 1]
+            friction = counter*FRICTION_COEFFICIENT
+            f_x = numpy.where(v[:, 0] < 0, f[:, 0] + friction,
+                    f[:, 0] - friction)
+            f_y = f[:, 1] + counter
+
+            before = v[:, 0]
+            v_x = before + f_x*dt/m
+            v_x[((v_x < 0) & (before > 0)) | ((v_x > 0) & (before < 0))] = 0.0
+            v_y = v[:, 1] + f_y*dt/m
+
+            velocity[below, 0] = v_x
+            velocity[below, 1] = v_y
+            position[below, 0] = p[:, 0] + v_x*dt
+            position[below, 1] = p[:, 1] + v_y*dt
+
+        velocity *= (1-dt*DAMPING_COEFFICIENT)
+
+    def sync(self):
+        if not self.built:
+            return
+        position = self.position.tolist()
+        velocity = self.velocity.tolist()
+        voltage = self.voltage.tolist()
+        phase = self.phase.tolist()
+        for k, c in enumerate(self.cells):
+            c.position[0], c.position[1] = position[k]
+            c.velocity[0], c.velocity[1] = velocity[k]
+            c.voltage = voltage[k]
+            c.phase = phase[k]
+        for a, timer in zip(self.agents, self.pacemaker_timer.tolist()):
+            a.pacemaker_timer = timer
@@ -0,0 +1,222 @@
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import genefile
+from agents import Agent
+from config import read_parameters
+from evaluation import Evaluation
+from physics import World
+from workers import ScoringPool
+
+# Benchmarks of the simulation on the populations in genes/ and the
+# configurations which evolve them.
+#
+#   python -m src.benchmark run RESULTS [CONFIG ...]
+#   python -m src.benchmark compare BASELINE RESULTS [TOLERANCE]
+#
+# run measures, for each CONFIG (a.conf, b.conf and c.conf by default):
+#   world_step:   World.step cell-steps per second
+#   array_step:   the same for ArrayWorld, if NumPy is installed
+#   cppn:         Genome.cppn evaluations per second over the growth grid
+#   growth:       milliseconds to construct an Agent
+#   score_genome: seconds to score one genome for the full evaluation_time
+#   generation:   genomes scored per second by a ScoringPool, for each of
+#                 PROCESS_COUNTS and the configured scoring_process_count
+# and writes them to RESULTS as JSON. Timings are the best of REPEATS runs,
+# except score_genome and generation, which are run once. compare lists
+# every result which is worse in RESULTS than in BASELINE by more than
+# TOLERANCE (a fraction, 0.1 by default), and exits with status 1 if there
+# are any.
+
+REPEATS = 3
+STEP_COUNT = 200
+GENOME_COUNT = 5
+SCORED_COUNT = 3
+PROCESS_COUNTS = [1, 2, 4]
+CONFIGS = ["a.conf", "b.conf", "c.conf"]
+
+parameters = {
+    "scoring_process_count": [int, 5],
+    "delta_t": [float, 0.01],
+    "evaluation_time": [float, 20],
+    "max_cell_count": [int, 30],
+    "pacemaker_period": [float, 1.0],
+    "population_size": [int, 20],
+    "input_file": [str, None],
+}
+
+def best_time(function, repeats=REPEATS):
+    times = []
+    for _ in xrange(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+def grow(genome, config):
+    max_cell_count = config["max_cell_count"]
+    agent = Agent(genome, max_cell_count/2, max_cell_count,
+            config["pacemaker_period"])
+    agent.translate([0, max_cell_count/4+1])
+    return agent
+
+def step_rate(genomes, config, create_world):
+    worlds = []
+    for genome in genomes:
+        world = create_world(config["delta_t"])
+        world.add_agent(grow(genome, config))
+        world.step()
+        worlds.append(world)
+    cell_count = sum([len(world.bodies) for world in worlds])
+
+    def run():
+        for world in worlds:
+            for _ in xrange(STEP_COUNT):
+                world.step()
+    return cell_count*STEP_COUNT/best_time(run)
+
+def cppn_rate(genomes, config):
+    grid_size = config["max_cell_count"]/2
+    agent = grow(genomes[0], config)
+    inputs = [agent.cppn_inputs(i, j, a) for i in xrange(grid_size) \
+            for j in xrange(grid_size) for a in xrange(1, 5)]
+    for genome in genomes:
+        genome.cppn(inputs[0])
+
+    def run():
+        for genome in genomes:
+            for x in inputs:
+                genome.cppn(x)
+    return len(genomes)*len(inputs)/best_time(run)
+
+# CPPNs are compiled beforehand and growth results not memoized, so this
+# is the time growth takes for a genome a scoring process has seen before.
+def growth_time(genomes, config):
+    for genome in genomes:
+        genome.cppn([0.0]*genome.input_count)
+
+    def run():
+        for genome in genomes:
+            genome.growth_cache = None
+            grow(genome, config)
+    return 1000*best_time(run)/len(genomes)
+
+def score(genome, config):
+    max_cell_count = config["max_cell_count"]
+    evaluation = Evaluation(genome, World(config["delta_t"]),
+            max_cell_count/2, max_cell_count, config["pacemaker_period"],
+            config["evaluation_time"])
+    evaluation.advance()
+    return evaluation.score()
+
+def score_items(items):
+    return [score(genome, config) for genome, config in items]
+
+def generation_rate(genomes, config, process_count):
+    pool = ScoringPool(process_count)
+    start = time.time()
+    pool.map(score_items, [[i, [genome, config]] \
+            for i, genome in enumerate(genomes)])
+    elapsed = time.time() - start
+    pool.close()
+    return len(genomes)/elapsed
+
+def result(value, unit, better):
+    return {"value": value, "unit": unit, "better": better}
+
+def run_config(file_name):
+    config = read_parameters(open(file_name, "r"), parameters)
+    population = genefile.load(config["input_file"])
+    population = population[:config["population_size"]]
+    genomes = population[:GENOME_COUNT]
+
+    results = {}
+    results["world_step"] = result(step_rate(genomes, config, World),
+            "cell-steps/s", "higher")
+    if numpy != None:
+        from arrayphysics import ArrayWorld
+        results["array_step"] = result(step_rate(genomes, config,
+                ArrayWorld), "cell-steps/s", "higher")
+    results["cppn"] = result(cppn_rate(genomes, config), "evaluations/s",
+            "higher")
+    results["growth"] = result(growth_time(genomes, config), "ms",
+            "lower")
+    start = time.time()
+    for genome in population[:SCORED_COUNT]:
+        score(genome, config)
+    results["score_genome"] = result((time.time() - start)/SCORED_COUNT,
+            "s", "lower")
+    counts = sorted(set(PROCESS_COUNTS + [config["scoring_process_count"]]))
+    for count in counts:
+        results["generation_%d" % count] = result(generation_rate(
+                population, config, count), "genomes/s", "higher")
+    return results
+
+def run(output_file_name, config_file_names):
+    report = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__ if numpy != None else None,
+        "cpu_count": multiprocessing.cpu_count(),
+        "results": {},
+    }
+    for file_name in config_file_names:
+        results = run_config(file_name)
+        report["results"][file_name] = results
+        for name in sorted(results):
+            print "%s %-14s %12.2f %s" % (file_name, name,
+                    results[name]["value"], results[name]["unit"])
+    f = open(output_file_name, "w")
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+
+# Returns [config, name, baseline value, value, relative change] for each
+# result in both reports; a positive change is an improvement.
+def compare(baseline, report):
+    changes = []
+    for config in sorted(report["results"]):
+        if config not in baseline["results"]:
+            continue
+        for name in sorted(report["results"][config]):
+            before = baseline["results"][config].get(name)
+            after = report["results"][config][name]
+            if before == None or before["value"] == 0:
+                continue
+            change = after["value"]/before["value"] - 1
+            if after["better"] == "lower":
+                change = before["value"]/after["value"] - 1
+            changes.append([config, name, before["value"], after["value"],
+                    change])
+    return changes
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "run":
+        run(sys.argv[2], sys.argv[3:] if len(sys.argv) > 3 else CONFIGS)
+    elif len(sys.argv) in [4, 5] and sys.argv[1] == "compare":
+        tolerance = float(sys.argv[4]) if len(sys.argv) == 5 else 0.1
+        baseline = json.load(open(sys.argv[2], "r"))
+        report = json.load(open(sys.argv[3], "r"))
+        regressions = 0
+        for config, name, before, after, change \
+                in compare(baseline, report):
+            flag = ""
+            if change < -tolerance:
+                flag = "REGRESSION"
+                regressions += 1
+            print "%s %-14s %12.2f %12.2f %+6.1f%% %s" % (config, name,
+                    before, after, 100*change, flag)
+        if regressions > 0:
+            sys.exit(1)
+    else:
+        print "usage: python -m src.benchmark run RESULTS [CONFIG ...]"
+        print "       python -m src.benchmark compare BASELINE RESULTS " \
+                + "[TOLERANCE]"
+        sys.exit(1)
@@ -0,0 +1,14 @@
+import re
+
+# Reads the "name = value" lines of a configuration file, as evolve.py
+# does, for the names in parameters, a dict from name to [type, default].
+# Returns a dict from name to value.
+def read_parameters(f, parameters):
+    values = dict([[name, default] for name, [_, default] \
+            in parameters.iteritems()])
+    for line in f:
+        match = re.match("\\s*([a-zA-Z_]+)\\s*=\\s*([^\\s]+)$", line)
+        if match != None and match.group(1) in parameters:
+            values[match.group(1)] = \
+                    parameters[match.group(1)][0](match.group(2))
+    return values
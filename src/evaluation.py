@@ -0,0 +1,223 @@
+import time
+
+import physics
+import profiling
+from agents import Agent
+from trajectory import Recorder
+
+# One genome's scoring run: the agent, the world simulating it and the
+# simulated time so far, so a run can be advanced in stages.
+class Evaluation:
+    def __init__(self, genome, world, grid_size, max_cell_count,
+            pacemaker_period, evaluation_time, batch_cppn=False):
+        start = time.time()
+        self.agent = Agent(genome, grid_size, max_cell_count,
+                pacemaker_period, batch_cppn)
+        profiling.add("growth", time.time() - start)
+        profiling.add("cppn", self.agent.cppn_time)
+        profiling.add("cppn_evaluations", self.agent.cppn_count)
+        profiling.add("evaluations", 1)
+        self.agent.translate([0, grid_size/2+1])
+        self.world = world
+        self.world.add_agent(self.agent)
+        self.max_cell_count = max_cell_count
+        self.evaluation_time = evaluation_time
+
+        self.x_start = self.agent.center_of_mass()[0]
+        self.sim_timer = 0.0
+        self.step_count = 0
+        self.stopped = False
+
+        self.threshold = None
+        self.reached = False
+        self.bound = None
+        self.last_check = None
+        self.max_speed = 0.0
+
+        self.period = None
+        self.snapshots = []
+        self.extrapolated = None
+
+        self.recorder = None
+
+    # Stop early once the agent's score looks unable to reach threshold,
+    # assuming it never moves faster than speed_margin times its fastest
+    # observed speed. That is an assumption, not a proof: an agent can
+    # speed up by more, so a genome which would have reached threshold can
+    # be stopped. Its speed while still is not taken as a bound, since
+    # agents at rest are set moving again by the pacemaker, and gaits often
+    # start late. A stopped evaluation scores the bound rather than its
+    # partial displacement. Checks are made every check_interval seconds,
+    # starting once the agent has been observed for stall_window seconds;
+    # an agent whose score has reached threshold at a check is never
+    # stopped, and neither is one with at most a step left.
+    def stop_below(self, threshold, stall_window, speed_margin,
+            check_interval=0.25):
+        self.threshold = threshold
+        self.stall_window = stall_window
+        self.speed_margin = speed_margin
+        self.check_steps = max(1,
+                int(round(check_interval/self.world.delta_t)))
+
+    # Once the agent's state relative to its center of mass (cell
+    # positions, velocities, voltages and phases) repeats after one to
+    # max_periods pacemaker periods within tolerance, its gait has settled,
+    # and the rest of the run is extrapolated from the displacement over
+    # that cycle. With validate set the simulation runs to the end anyway,
+    # so the extrapolation can be compared with the simulated result.
+    def extrapolate_periodic(self, period, tolerance, validate=False, 
+            max_periods=4):
+        self.period = period
+        self.tolerance = tolerance
+        self.validate = validate
+        self.max_periods = max_periods
+        self.period_count = 0
+
+    # Record the agent's cells every frame_interval seconds of simulated
+    # time from now on, for replaying the run without simulating it.
+    def record(self, frame_interval):
+        self.frame_steps = max(1,
+                int(round(frame_interval/self.world.delta_t)))
+        self.recorder = Recorder(self.agent.cells,
+                self.frame_steps*self.world.delta_t)
+        self.capture()
+
+    def capture(self):
+        self.world.sync()
+        self.recorder.capture(self.agent.cells)
+
+    def trajectory(self):
+        if self.recorder == None:
+            return None
+        return self.recorder.encode()
+
+    def advance(self, time_limit=None):
+        if time_limit == None:
+            time_limit = self.evaluation_time
+        start = time.time()
+        contacts = physics.ground_contacts
+        step_count = self.step_count
+        while self.sim_timer < time_limit and not self.stopped:
+            if self.extrapolated != None and not self.validate:
+                break
+            self.world.step()
+            self.sim_timer += self.world.delta_t
+            self.step_count += 1
+            if self.recorder != None \
+                    and self.step_count % self.frame_steps == 0:
+                self.capture()
+            if self.threshold != None \
+                    and self.step_count % self.check_steps == 0:
+                self.check()
+            if self.period != None \
+                    and self.sim_timer >= (self.period_count+1)*self.period:
+                self.period_count += 1
+                self.check_period()
+        profiling.add("simulation", time.time() - start)
+        profiling.add("cell_steps", 
+                (self.step_count - step_count)*self.agent.cell_count)
+        profiling.add("ground_contacts", physics.ground_contacts - contacts)
+
+    def check(self):
+        x = self.displacement()
+        if self.last_check != None:
+            t, x_previous = self.last_check
+            speed = abs(x - x_previous)/(self.sim_timer - t)
+            self.max_speed = max(self.max_speed, speed)
+        self.last_check = [self.sim_timer, x]
+        # agents spend their first moments falling to the ground, which
+        # says nothing about how fast they can walk
+        if self.sim_timer < self.stall_window:
+            return
+        if abs(x)*self.size_factor() >= self.threshold:
+            self.reached = True
+        remaining = self.evaluation_time - self.sim_timer
+        if self.reached or remaining <= self.world.delta_t:
+            return
+
+        bound = abs(x) + self.speed_margin*self.max_speed*remaining
+        if bound*self.size_factor() < self.threshold:
+            self.bound = bound
+            self.stopped = True
+
+    def check_period(self):
+        x = self.displacement()
+        x_center = self.agent.center_of_mass()[0]
+        state = []
+        phases = []
+        for cell in self.agent.cells:
+            state += [cell.position[0] - x_center, cell.position[1], 
+                    cell.velocity[0], cell.velocity[1], cell.voltage]
+            phases.append(cell.phase)
+        if self.extrapolated != None:
+            return
+
+        for t, x_previous, state_previous, phases_previous \
+                in reversed(self.snapshots):
+            if phases != phases_previous:
+                continue
+            if max([abs(a - b) for a, b \
+                    in zip(state, state_previous)]) > self.tolerance:
+                continue
+            remaining = self.evaluation_time - self.sim_timer
+            self.extrapolated = x \
+                    + (x - x_previous)*remaining/(self.sim_timer - t)
+            return
+
+        self.snapshots.append([self.sim_timer, x, state, phases])
+        del self.snapshots[:-self.max_periods]
+
+    def extrapolation_error(self):
+        if self.extrapolated == None or not self.validate \
+                or not self.complete():
+            return None
+        return abs(self.extrapolated - self.displacement())
+
+    def displacement(self):
+        self.world.sync()
+        return self.agent.center_of_mass()[0] - self.x_start
+
+    def size_factor(self):
+        return 0.5 + 0.5*self.agent.cell_count/self.max_cell_count
+
+    def score(self):
+        if self.stopped:
+            return self.bound*self.size_factor()
+        if self.extrapolated != None and not self.validate:
+            return abs(self.extrapolated)*self.size_factor()
+        return abs(self.displacement())*self.size_factor()
+
+    def complete(self):
+        if self.stopped:
+            return False
+        if self.extrapolated != None and not self.validate:
+            return True
+        return self.sim_timer >= self.evaluation_time
+
+# Advances evaluations whose agents share one world, such as a batched
+# ArrayWorld, stepping the world once for all of them.
+def advance_together(evaluations, time_limit=None):
+    world = evaluations[0].world
+    if time_limit == None:
+        time_limit = evaluations[0].evaluation_time
+    start = time.time()
+    contacts = physics.ground_contacts
+    step_count = evaluations[0].step_count
+    while evaluations[0].sim_timer < time_limit:
+        world.step()
+        captured = []
+        for evaluation in evaluations:
+            evaluation.sim_timer += world.delta_t
+            evaluation.step_count += 1
+            if evaluation.recorder != None \
+                    and evaluation.step_count % evaluation.frame_steps == 0:
+                captured.append(evaluation)
+        # the world is synced once for all the agents recorded in a frame
+        if len(captured) > 0:
+            world.sync()
+            for evaluation in captured:
+                evaluation.recorder.capture(evaluation.agent.cells)
+    profiling.add("simulation", time.time() - start)
+    profiling.add("cell_steps", (evaluations[0].step_count - step_count) \
+            *sum([e.agent.cell_count for e in evaluations]))
+    profiling.add("ground_contacts", physics.ground_contacts - contacts)
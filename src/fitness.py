@@ -0,0 +1,59 @@
+import anydbm
+import collections
+import hashlib
+
+# Scores of previously simulated genomes. The simulation is deterministic,
+# so a genome's score depends only on its rules, its materials and the
+# simulation parameters, all of which go into the key.
+class FitnessCache:
+    def __init__(self, parameters, capacity, file_name=None):
+        self.parameters = repr(parameters)
+        self.capacity = capacity
+        self.scores = collections.OrderedDict()
+        self.store = None
+        if file_name != None:
+            self.store = anydbm.open(file_name, 'c')
+
+        self.hits = 0
+        self.lookups = 0
+
+    def key(self, genome):
+        h = hashlib.sha1(self.parameters)
+        h.update(repr(genome.rules))
+        h.update(repr([[p[1] for p in m] for m in genome.materials]))
+        return h.hexdigest()
+
+    def get(self, genome):
+        key = self.key(genome)
+        self.lookups += 1
+        if key in self.scores:
+            score = self.scores.pop(key)
+        elif self.store != None and key in self.store:
+            score = float(self.store[key])
+        else:
+            return None
+
+        self.hits += 1
+        self.remember(key, score)
+        return score
+
+    def put(self, genome, score):
+        key = self.key(genome)
+        self.remember(key, score)
+        if self.store != None:
+            self.store[key] = repr(score)
+
+    def remember(self, key, score):
+        self.scores.pop(key, None)
+        self.scores[key] = score
+        while len(self.scores) > self.capacity:
+            self.scores.popitem(last=False)
+
+    def sync(self):
+        if self.store != None and hasattr(self.store, "sync"):
+            self.store.sync()
+
+    def close(self):
+        if self.store != None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,220 @@
+import array
+import mmap
+import pickle
+import struct
+import sys
+
+from genetics import Genome, rules, properties
+
+# Binary population files. The header holds the genome dimensions and an
+# offset table, so single genomes can be decoded from a memory map without
+# reading the rest. Each record is the score, one opcode per rule (its
+# index in genetics.rules), two argument tags and two argument indices per
+# rule, the material values and a pool of the constants the arguments
+# index into. All values are little-endian.
+#
+#   header:  magic, version, rule_count, material_count, input_count,
+#            property_count, genome_count
+#   offsets: genome_count+1 unsigned 64-bit file offsets of the records
+#   record:  score (float64), opcodes (uint8 x rule_count),
+#            tags (uint8 x 2*rule_count), indices (uint16 x 2*rule_count),
+#            materials (float64 x material_count*property_count),
+#            constant_count (uint16), constants (float64 x constant_count)
+
+MAGIC = "CRGN"
+VERSION = 1
+HEADER = struct.Struct("<4sHIHHHI")
+
+NONE, RULE, CONSTANT, INPUT = 0, 1, 2, 3
+tags = {"rule": RULE, "constant": CONSTANT, "input": INPUT}
+tag_names = dict([[t, name] for name, t in tags.iteritems()])
+opcodes = dict([[rule[0], i] for i, rule in enumerate(rules)])
+
+def decode_array(code, data):
+    a = array.array(code)
+    a.fromstring(data)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+def encode(genome):
+    # array-backed genomes hold their record's contents already
+    if hasattr(genome, "record"):
+        return genome.record()
+    rule_count = genome.rule_count
+    ops = array.array("B", [0]*rule_count)
+    arg_tags = array.array("B", [NONE]*(2*rule_count))
+    indices = array.array("H", [0]*(2*rule_count))
+    constants = array.array("d")
+    for i, rule in enumerate(genome.rules):
+        ops[i] = opcodes[rule[0]]
+        for k, arg in enumerate(rule[1:]):
+            tag = tags[arg[0]]
+            arg_tags[2*i+k] = tag
+            if tag == CONSTANT:
+                indices[2*i+k] = len(constants)
+                constants.append(arg[1])
+            else:
+                indices[2*i+k] = arg[1]
+    materials = array.array("d", [p[1] for m in genome.materials for p in m])
+    for a in [indices, materials, constants]:
+        if sys.byteorder != "little":
+            a.byteswap()
+    return "".join([struct.pack("<d", genome.score), ops.tostring(),
+        arg_tags.tostring(), indices.tostring(), materials.tostring(),
+        struct.pack("<H", len(constants)), constants.tostring()])
+
+# Every argument may be a constant, so a record is at most this long.
+def max_record_size(rule_count, material_count):
+    return 8 + rule_count + 2*rule_count + 2*2*rule_count \
+            + 8*material_count*len(properties) + 2 + 8*2*rule_count
+
+def save(genomes, f):
+    first = genomes[0]
+    dimensions = [first.rule_count, first.material_count, first.input_count]
+    # constant pool indices share the 16-bit index field
+    if first.rule_count >= 1 << 15:
+        raise ValueError("rule_count too large for binary format")
+    records = []
+    for genome in genomes:
+        if [genome.rule_count, genome.material_count,
+                genome.input_count] != dimensions:
+            raise ValueError("genomes differ in dimensions")
+        records.append(encode(genome))
+
+    offsets = []
+    offset = HEADER.size + 8*(len(records)+1)
+    for record in records:
+        offsets.append(offset)
+        offset += len(record)
+    offsets.append(offset)
+    f.write(HEADER.pack(MAGIC, VERSION, first.rule_count,
+            first.material_count, first.input_count, len(properties),
+            len(genomes)))
+    f.write(struct.pack("<%dQ" % len(offsets), *offsets))
+    for record in records:
+        f.write(record)
+
+# Decodes the record starting at position in data, any string or buffer.
+def decode(data, position, rule_count, material_count, input_count):
+    material_size = material_count*len(properties)
+
+    def take(code, count):
+        start = position
+        end = start + count*array.array(code).itemsize
+        return decode_array(code, data[start:end]), end
+
+    score = struct.unpack_from("<d", data, position)[0]
+    position += 8
+    ops, position = take("B", rule_count)
+    arg_tags, position = take("B", 2*rule_count)
+    indices, position = take("H", 2*rule_count)
+    materials, position = take("d", material_size)
+    constant_count = struct.unpack_from("<H", data, position)[0]
+    position += 2
+    constants, position = take("d", constant_count)
+
+    genome = Genome(rule_count, material_count, input_count)
+    genome.score = score
+    names = [rule[0] for rule in rules]
+    args = []
+    for tag, index in zip(arg_tags.tolist(), indices.tolist()):
+        if tag == CONSTANT:
+            args.append(["constant", constants[index]])
+        elif tag != NONE:
+            args.append([tag_names[tag], index])
+        else:
+            args.append(None)
+    genome.rules = []
+    for j, op in enumerate(ops.tolist()):
+        rule = [names[op], args[2*j]]
+        if args[2*j+1] != None:
+            rule.append(args[2*j+1])
+        genome.rules.append(rule)
+    genome.materials = []
+    for j in xrange(material_count):
+        values = materials[j*len(properties):(j+1)*len(properties)]
+        genome.materials.append([[p, v] for p, v \
+                in zip(properties, values)])
+    return genome
+
+# Read-only view of a binary population file. Genomes are decoded one at a
+# time when indexed; score(i) reads a single score without decoding.
+class GeneFile:
+    def __init__(self, file_name):
+        self.file = open(file_name, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rule_count, self.material_count, \
+                self.input_count, self.property_count, self.genome_count \
+                = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary population file" \
+                    % file_name)
+        if version != VERSION:
+            raise ValueError("%s has unsupported version %d" \
+                    % (file_name, version))
+        if self.property_count != len(properties):
+            raise ValueError("%s has %d material properties, expected %d" \
+                    % (file_name, self.property_count, len(properties)))
+        self.offsets = struct.unpack_from("<%dQ" % (self.genome_count+1),
+                self.data, HEADER.size)
+
+    def __len__(self):
+        return self.genome_count
+
+    def score(self, i):
+        return struct.unpack_from("<d", self.data, self.offsets[i])[0]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.genome_count
+        if i < 0 or i >= self.genome_count:
+            raise IndexError("genome index out of range")
+        return decode(self.data, self.offsets[i], self.rule_count,
+                self.material_count, self.input_count)
+
+    def __iter__(self):
+        for i in xrange(self.genome_count):
+            yield self[i]
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+def is_binary(file_name):
+    f = open(file_name, "rb")
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+# Loads a population from either format, telling them apart by the magic
+# number at the start of binary files.
+def load(file_name):
+    if not is_binary(file_name):
+        f = open(file_name, "r")
+        genomes = pickle.load(f)
+        f.close()
+        return genomes
+    gene_file = GeneFile(file_name)
+    genomes = list(gene_file)
+    gene_file.close()
+    return genomes
+
+def dump(genomes, file_name, population_format="binary"):
+    if population_format == "binary":
+        f = open(file_name, "wb")
+        save(genomes, f)
+    else:
+        f = open(file_name, "w")
+        pickle.dump(genomes, f)
+    f.close()
+
+def convert(source, destination, population_format="binary"):
+    dump(load(source), destination, population_format)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print "usage: python -m src.genefile source destination " \
+                + "[binary|pickle]"
+        sys.exit(1)
+    convert(*sys.argv[1:])
@@ -1,6 +1,11 @@
 import random
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 rules = [["sine", 1], ["cosine", 1], ["tanh", 1], ["gaussian", 1], ["mean", 2], ["product", 2], ["ramp", 1], ["step", 1], ["spike", 1], ["inverse", 1]]
 properties = ["axial_stiffness", "bending_stiffness", "expansion", "dissipation", "activation_rate", "transmittivity", "contact_response"]
 
@@ -10,8 +15,55 @@ class Genome:
         self.material_count = material_count
         self.input_count = input_count
         self.score = 0.0
+        self.evaluator = None
+        self.batch_evaluator = None
+        self.live = None
+        self.references = None
+        # CPPN results by growth position, kept by Agent
+        self.growth_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ["evaluator", "batch_evaluator", "live", "references",
+                "growth_cache"]:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.evaluator = None
+        self.batch_evaluator = None
+        self.live = None
+        self.references = None
+        self.growth_cache = None
 
     def cppn(self, inputs):
+        growth, material_index = self.cppn_index(inputs)
+        return growth, self.materials[material_index]
+
+    def cppn_index(self, inputs):
+        if self.evaluator is None:
+            self.update_liveness()
+            self.evaluator = compile_rules(self.rules, 
+                    self.material_count+1, self.live)
+        outputs = self.evaluator(inputs)
+        material_index = max(range(self.material_count), 
+                key=lambda x:outputs[x+1])
+        return outputs[0], material_index
+
+    # Evaluates the CPPN at every row of an N x 4 input array at once,
+    # returning arrays of growth values and material indices which match
+    # cppn() exactly.
+    def cppn_batch(self, inputs):
+        if self.batch_evaluator is None:
+            self.update_liveness()
+            self.batch_evaluator = compile_rules(self.rules, 
+                    self.material_count+1, self.live, True)
+        outputs = self.batch_evaluator(numpy.asarray(inputs, dtype=float))
+        outputs = numpy.array(numpy.broadcast_arrays(*outputs))
+        return outputs[0], numpy.argmax(outputs[1:], 0)
+
+    def interpret(self, inputs):
         values = []
         for rule in self.rules:
             params = []
@@ -58,7 +110,67 @@ class Genome:
                 key=lambda x:outputs[x+1])
         return outputs[0], self.materials[material_index]
 
+    # Only the last material_count+1 rules are read as outputs; a rule is
+    # live if it is an output or an argument of a live rule. references[i]
+    # counts the live rules using rule i, so replace_rule can update
+    # liveness incrementally instead of sweeping the whole genome.
+    def update_liveness(self):
+        if self.live is not None:
+            return
+        rule_count = len(self.rules)
+        first_output = rule_count - (self.material_count+1)
+        self.live = [False]*rule_count
+        self.references = [0]*rule_count
+        for i in xrange(rule_count-1, -1, -1):
+            if i >= first_output or self.references[i] > 0:
+                self.live[i] = True
+                for arg in self.rules[i][1:]:
+                    if arg[0] == "rule":
+                        self.references[arg[1]] += 1
+
+    def live_rule_count(self):
+        self.update_liveness()
+        return sum(self.live)
+
+    def replace_rule(self, i, rule):
+        old = self.rules[i]
+        self.rules[i] = rule
+        self.evaluator = None
+        self.batch_evaluator = None
+        self.growth_cache = None
+        if self.live is not None and self.live[i]:
+            self.retain_arguments(rule)
+            self.release_arguments(old)
+
+    def retain_arguments(self, rule):
+        pending = [rule]
+        while len(pending) > 0:
+            for arg in pending.pop()[1:]:
+                if arg[0] == "rule":
+                    j = arg[1]
+                    self.references[j] += 1
+                    if not self.live[j]:
+                        self.live[j] = True
+                        pending.append(self.rules[j])
+
+    def release_arguments(self, rule):
+        first_output = len(self.rules) - (self.material_count+1)
+        pending = [rule]
+        while len(pending) > 0:
+            for arg in pending.pop()[1:]:
+                if arg[0] == "rule":
+                    j = arg[1]
+                    self.references[j] -= 1
+                    if self.references[j] == 0 and j < first_output:
+                        self.live[j] = False
+                        pending.append(self.rules[j])
+
     def randomize(self):
+        self.evaluator = None
+        self.batch_evaluator = None
+        self.growth_cache = None
+        self.live = None
+        self.references = None
         self.rules = [self.random_rule(i) \
                 for i in xrange(self.rule_count)]
         self.materials = [self.random_material() \
@@ -92,11 +204,12 @@ class Genome:
         for i in xrange(self.rule_count):
             rand = random.random()
             if rand < r/2:
-                self.rules[i] = self.random_rule(i)
+                self.replace_rule(i, self.random_rule(i))
             elif rand < r:
-                rule = self.rules[i]
+                rule = self.rules[i][:]
                 j = random.randint(1, len(rule)-1)
                 rule[j] = self.random_parameter(i, True if j>0 else False)
+                self.replace_rule(i, rule)
 
         for i in xrange(self.material_count):
             rand = random.random()
@@ -112,9 +225,10 @@ class Genome:
         if j < i:
             i, j = j, i
 
-        temp = self.rules[i:j]
-        self.rules = self.rules[:i]+other.rules[i:j]+self.rules[j:]
-        other.rules = other.rules[:i]+temp+other.rules[j:]
+        for k in xrange(i, j):
+            rule = self.rules[k]
+            self.replace_rule(k, other.rules[k])
+            other.replace_rule(k, rule)
 
         i = random.randint(0, self.material_count)
         j = random.randint(0, self.material_count)
@@ -137,6 +251,9 @@ class Genome:
 	    g.materials.append([p[:] for p in material])
 
         g.score = self.score
+        if self.live is not None:
+            g.live = self.live[:]
+            g.references = self.references[:]
 
         return g
 
@@ -160,6 +277,52 @@ class Genome:
 
         return s
 
+# Expressions mirror Genome.interpret exactly, so compiled genomes give
+# bit-identical outputs. Vectorized evaluators run the same expressions on
+# NumPy arrays, one column of inputs per CPPN input.
+rule_expressions = {
+    "sine": "sin(%s)/2 + 0.5",
+    "cosine": "cos(2*pi*%s)/2 + 0.5",
+    "tanh": "tanh(4*%s-2)/2 + 0.5",
+    "gaussian": "gauss(6*%s - 3)",
+    "mean": "(%s + %s)/2",
+    "product": "%s*%s",
+    "ramp": "2*%s %% 1",
+    "step": "step(%s)",
+    "spike": "spike(%s)",
+    "inverse": "1.0 - %s",
+}
+
+def compile_rules(rules, output_count, live=None, vectorized=False):
+    input_format = "inputs[:, %d]" if vectorized else "inputs[%d]"
+    lines = ["def evaluate(inputs):"]
+    for i, rule in enumerate(rules):
+        if live is not None and not live[i]:
+            continue
+        params = []
+        for arg in rule[1:]:
+            if arg[0] == "rule":
+                params.append("v%d" % arg[1])
+            elif arg[0] == "constant":
+                params.append("(%r)" % arg[1])
+            elif arg[0] == "input":
+                params.append(input_format % arg[1])
+        lines.append("    v%d = %s" % (i, rule_expressions[rule[0]] \
+                % tuple(params)))
+    outputs = ["v%d" % i for i in \
+            xrange(len(rules)-output_count, len(rules))]
+    lines.append("    return [%s]" % ", ".join(outputs))
+
+    if vectorized:
+        namespace = {"sin": numpy.sin, "cos": numpy.cos, 
+                "tanh": numpy.tanh, "pi": math.pi, "gauss": array_gauss, 
+                "step": array_step, "spike": array_spike}
+    else:
+        namespace = {"sin": math.sin, "cos": math.cos, "tanh": math.tanh, 
+                "pi": math.pi, "gauss": gauss, "step": step, "spike": spike}
+    exec compile("\n".join(lines), "<genome>", "exec") in namespace
+    return namespace["evaluate"]
+
 def gauss(x):
     return math.e**(-x**2/2)
 
@@ -174,3 +337,15 @@ def spike(x):
     if y > 1:
         y = 2 - y
     return y
+
+def array_gauss(x):
+    # numpy computes x**2 as x*x, which can round differently from pow()
+    square = numpy.power(x, numpy.full(numpy.shape(x), 2.0))
+    return numpy.power(math.e, -square/2)
+
+def array_step(x):
+    return numpy.where(x % 1 > 0.5, 1.0, 0.0)
+
+def array_spike(x):
+    y = 2*(x % 1)
+    return numpy.where(y > 1, 2 - y, y)
@@ -1,29 +1,88 @@
+import time
 import Tkinter
 
 from physics import Body, Cell, World
+from trajectory import ReplayWorld
 
+# Cell colors by voltage from -1 to 1 in steps of 1/COLOR_RESOLUTION, taken
+# from Cell.get_color once rather than every frame.
+COLOR_RESOLUTION = 100
+
+def color_string(rgb):
+    return "#%02x%02x%02x" % tuple(rgb)
+
+def color_table():
+    cell = Cell(1.0, [0.0, 0.0], 0, 0, 0, 0, 0, 0, False)
+    colors = []
+    for i in xrange(2*COLOR_RESOLUTION + 1):
+        cell.voltage = -1 + 1.0*i/COLOR_RESOLUTION
+        colors.append(color_string(cell.get_color()))
+    return colors
+
+COLORS = color_table()
+WHITE = color_string([255, 255, 255])
+
+def voltage_color(voltage):
+    if -1 < voltage < 1:
+        return COLORS[int((voltage + 1)*COLOR_RESOLUTION + 0.5)]
+    elif voltage <= -1:
+        return COLORS[0]
+    return COLORS[-1]
+
+# Draws a world's bodies and the connections between its agents' cells.
+# The canvas items are created once for a world and moved and recolored in
+# place, and only when their pixel position or color changes. The window
+# stays open when another world is shown.
 class Display:
     def __init__(self, world, width, height):
-        global canvas
-        global image
-
-        self.world = world
         self.width = width
         self.height = height
+        self.root = Tkinter.Tk()
+        self.canvas = Tkinter.Canvas(self.root, width=width,
+                height=height, bg="black")
+        self.canvas.pack()
+        self.show(world)
 
+        self.frame_count = 0
+        self.skipped_count = 0
+        self.draw_time = 0.0
+        self.max_draw_time = 0.0
+        self.report_time = time.time()
+
+    def show(self, world):
+        self.world = world
+        self.bodies = None
         self.scale = 10000.0
-        self.left_edge = -width/(2*self.scale)
-        self.right_edge = width/(2*self.scale)
-        self.top_edge = height/(self.scale)
+        self.left_edge = -self.width/(2*self.scale)
+        self.right_edge = self.width/(2*self.scale)
+        self.top_edge = self.height/(self.scale)
 
-        self.root = Tkinter.Tk()
-        canvas = Tkinter.Canvas(self.root, width=width, 
-                height=height, bg="black")
-        canvas.pack()
+    def build(self):
+        canvas = self.canvas
+        canvas.delete("all")
+        self.bodies = list(self.world.bodies)
+        self.ovals = [canvas.create_oval(0, 0, 0, 0) for _ in self.bodies]
+        self.positions = [None]*len(self.bodies)
+        self.colors = [None]*len(self.bodies)
+
+        index = dict([[id(b), k] for k, b in enumerate(self.bodies)])
+        self.links = []
+        for a in self.world.agents:
+            for c0 in a.cells:
+                for c1 in c0.connections[:2]:
+                    if c1:
+                        self.links.append([index[id(c0)], index[id(c1)],
+                                canvas.create_line(0, 0, 0, 0, width=2,
+                                fill="white")])
+        self.report = canvas.create_text(5, 5, anchor="nw", fill="white",
+                text="")
 
     def refresh(self):
-        canvas.delete("all")
-        bodies = self.world.bodies
+        start = time.time()
+        if self.bodies == None or len(self.bodies) != len(self.world.bodies):
+            self.build()
+        canvas = self.canvas
+        bodies = self.bodies
         x_min = float("inf")
         x_max = -float("inf")
         y_max = 0
@@ -52,34 +111,83 @@ class Display:
             middle = self.right_edge
             self.right_edge += middle - self.left_edge
 
-        for b in bodies:
-            x = b.position[0]
-            y = b.position[1]
-            x0 = self.scale*(x-self.left_edge) - 5
-            y0 = self.height-self.scale*y - 5
-            x1 = self.scale*(x-self.left_edge) + 5
-            y1 = self.height-self.scale*y + 5
-            color = "#%02x%02x%02x" % tuple(b.get_color())
-            canvas.create_oval(x0, y0, x1, y1, fill=color)
-
-        cells = []
-        for a in self.world.agents:
-            cells += a.cells
-        for c0 in cells:
-            x = c0.position[0]
-            y = c0.position[1]
-            x0 = self.scale*(x-self.left_edge)
-            y0 = self.height-self.scale*y
-            for c1 in c0.connections[:2]:
-                if c1:
-                    x = c1.position[0]
-                    y = c1.position[1]
-                    x1 = self.scale*(x-self.left_edge)
-                    y1 = self.height-self.scale*y
-                    canvas.create_line(x0, y0, x1, y1, width=2, 
-                            fill="white")
+        moved = [False]*len(bodies)
+        for k, b in enumerate(bodies):
+            x = int(round(self.scale*(b.position[0]-self.left_edge)))
+            y = int(round(self.height-self.scale*b.position[1]))
+            if self.positions[k] != (x, y):
+                self.positions[k] = (x, y)
+                moved[k] = True
+                canvas.coords(self.ovals[k], x-5, y-5, x+5, y+5)
+            if isinstance(b, Cell):
+                color = voltage_color(b.voltage)
+            else:
+                color = WHITE
+            if self.colors[k] != color:
+                self.colors[k] = color
+                canvas.itemconfig(self.ovals[k], fill=color)
+
+        for k0, k1, line in self.links:
+            if moved[k0] or moved[k1]:
+                x0, y0 = self.positions[k0]
+                x1, y1 = self.positions[k1]
+                canvas.coords(line, x0, y0, x1, y1)
 
         canvas.update()
+        self.record_frame(time.time() - start)
+
+    # Frame times are shown in the corner, averaged over each second.
+    def record_frame(self, draw_time):
+        self.frame_count += 1
+        self.draw_time += draw_time
+        self.max_draw_time = max(self.max_draw_time, draw_time)
+        now = time.time()
+        if now - self.report_time < 1.0:
+            return
+        self.canvas.itemconfig(self.report,
+                text="%.0f fps, draw %.1f ms (max %.1f), %d skipped" \
+                % (self.frame_count/(now - self.report_time),
+                1000*self.draw_time/self.frame_count,
+                1000*self.max_draw_time, self.skipped_count))
+        self.frame_count = 0
+        self.skipped_count = 0
+        self.draw_time = 0.0
+        self.max_draw_time = 0.0
+        self.report_time = now
 
     def kill(self):
         self.root.withdraw()
+
+# Calls advance once per frame_interval of real time, refreshing the
+# display after each call, until something is put in queue, which is left
+# there for the caller. When drawing
+# falls behind, up to max_skipped frames in a row are advanced without
+# being drawn, to catch up. If advancing alone takes longer than a frame,
+# skipping cannot help, and the animation slows down instead.
+def animate(display, advance, frame_interval, queue=None, max_skipped=10):
+    next_time = time.time()
+    skipped = 0
+    while queue == None or queue.empty():
+        start = time.time()
+        advance()
+        now = time.time()
+        next_time += frame_interval
+        if now > next_time and skipped < max_skipped \
+                and now - start < frame_interval:
+            skipped += 1
+            display.skipped_count += 1
+            continue
+        skipped = 0
+        display.refresh()
+        now = time.time()
+        if now < next_time:
+            time.sleep(next_time - now)
+        elif now - next_time > max_skipped*frame_interval:
+            next_time = now
+
+# Shows a recorded trajectory at the speed it was simulated, from the start
+# again after its last frame.
+def play(trajectory, width, height):
+    world = ReplayWorld(trajectory)
+    display = Display(world, width, height)
+    animate(display, world.step, trajectory.frame_interval)
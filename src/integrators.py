@@ -0,0 +1,132 @@
+import sys
+import time
+
+import numpy
+
+import genefile
+from arrayphysics import ArrayWorld
+from config import read_parameters
+from evaluation import Evaluation
+from physics import FRICTION_COEFFICIENT
+from workers import ScoringPool
+
+# Compares the alternative integrators of ArrayWorld with the reference
+# (explicit Euler with re-integrated ground contact) at the step size the
+# genomes in genes/ were evolved with, by how well they preserve the rank
+# order of a population's scores. The simulation is chaotic, so scores
+# differ even for a slightly changed delta_t; the reference at 0.99 times
+# its step is reported as a floor for what to expect.
+#
+#   python -m src.integrators CONFIG [DELTA_T ...]
+#
+# scores the population in CONFIG's input_file with CONFIG's integrator,
+# ground_contact, contact_friction and implicit_weight at each DELTA_T.
+
+REFERENCE_DELTA_T = 0.01
+
+parameters = {
+    "scoring_process_count": [int, 5],
+    "evaluation_time": [float, 20],
+    "max_cell_count": [int, 30],
+    "pacemaker_period": [float, 1.0],
+    "integrator": [str, "euler"],
+    "ground_contact": [str, "reintegrate"],
+    "contact_friction": [float, FRICTION_COEFFICIENT],
+    "implicit_weight": [float, 1.0],
+    "input_file": [str, None],
+}
+
+# Returns [score, whether the simulation blew up, CPU seconds] for each
+# [genome, settings] item.
+def score_items(items):
+    results = []
+    for genome, settings in items:
+        config, delta_t, physics = settings
+        world = ArrayWorld(delta_t, *physics)
+        max_cell_count = config["max_cell_count"]
+        start = time.clock()
+        evaluation = Evaluation(genome, world, max_cell_count/2,
+                max_cell_count, config["pacemaker_period"],
+                config["evaluation_time"])
+        # unstable runs overflow; they are counted rather than warned about
+        with numpy.errstate(all="ignore"):
+            evaluation.advance()
+            score = evaluation.score()
+        elapsed = time.clock() - start
+        unstable = not numpy.all(numpy.isfinite(world.position)) \
+                or numpy.abs(world.position[:, 1]).max() > 100
+        if unstable or not numpy.isfinite(score):
+            score = float("-inf")
+        results.append([score, unstable, elapsed])
+    return results
+
+# ranks from 0, with tied values sharing their mean rank
+def ranks(values):
+    order = sorted(range(len(values)), key=lambda i:values[i])
+    result = [0.0]*len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j+1 < len(order) and values[order[j+1]] == values[order[i]]:
+            j += 1
+        for k in xrange(i, j+1):
+            result[order[k]] = (i+j)/2.0
+        i = j+1
+    return result
+
+def rank_correlation(a, b):
+    a = numpy.array(ranks(a))
+    b = numpy.array(ranks(b))
+    if a.std() == 0 or b.std() == 0:
+        return 0.0
+    return numpy.corrcoef(a, b)[0, 1]
+
+# fraction of the top quarter of a which is also in the top quarter of b
+def top_overlap(a, b):
+    count = max(1, len(a)/4)
+    top_a = sorted(range(len(a)), key=lambda i:-a[i])[:count]
+    top_b = sorted(range(len(b)), key=lambda i:-b[i])[:count]
+    return 1.0*len(set(top_a) & set(top_b))/count
+
+def report(genomes, config, steps):
+    physics = [config["integrator"], config["ground_contact"],
+            config["contact_friction"], config["implicit_weight"]]
+    rows = [["reference", REFERENCE_DELTA_T,
+                ["euler", "reintegrate", FRICTION_COEFFICIENT, 1.0]],
+            ["reference", 0.99*REFERENCE_DELTA_T,
+                ["euler", "reintegrate", FRICTION_COEFFICIENT, 1.0]]]
+    for delta_t in steps:
+        rows.append(["%s/%s" % (physics[0], physics[1]), delta_t, physics])
+
+    pool = ScoringPool(config["scoring_process_count"])
+    results = []
+    for name, delta_t, row_physics in rows:
+        items = [[i, [genome, [config, delta_t, row_physics]]] \
+                for i, genome in enumerate(genomes)]
+        scored = pool.map(score_items, items)
+        results.append([scored[i] for i in xrange(len(genomes))])
+    pool.close()
+
+    reference = [r[0] for r in results[0]]
+    reference_time = sum([r[2] for r in results[0]])
+    print "%d genomes, top quarter %d" % (len(genomes),
+            max(1, len(genomes)/4))
+    print "%-24s %8s %9s %8s %9s %8s" % ("physics", "delta_t", "unstable",
+            "rank r", "top 1/4", "speedup")
+    for [name, delta_t, _], result in zip(rows, results):
+        scores = [r[0] for r in result]
+        print "%-24s %8.4f %9d %8.3f %8.0f%% %7.2fx" % (name, delta_t,
+                sum([r[1] for r in result]),
+                rank_correlation(reference, scores),
+                100*top_overlap(reference, scores),
+                reference_time/sum([r[2] for r in result]))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: python -m src.integrators CONFIG [DELTA_T ...]"
+        sys.exit(1)
+    config = read_parameters(open(sys.argv[1], "r"), parameters)
+    steps = [float(s) for s in sys.argv[2:]]
+    if len(steps) == 0:
+        steps = [REFERENCE_DELTA_T*k for k in [1, 3, 5]]
+    report(genefile.load(config["input_file"]), config, steps)
@@ -6,64 +6,101 @@ DAMPING_COEFFICIENT = 3.0
 g = 20.0
 EAST, NORTH, WEST, SOUTH = 0, 1, 2, 3
 
+TWO_PI = 2*math.pi
+# rest angle between connections k directions apart
+BEND_OFFSETS = [math.pi*k/2 for k in xrange(4)]
+
+# body-steps which ended below the ground, in this process
+ground_contacts = 0
+
+# Bodies keep their state in slots and accumulate forces in two scalars,
+# so a step allocates nothing but floats. position and velocity stay
+# two-element lists, updated in place, for the code which reads them.
 class Body(object):
+    __slots__ = ["mass", "position", "velocity", "force_x", "force_y"]
+
     def __init__(self, mass, position):
         self.mass = mass
         self.position = position
         self.velocity = [0, 0]
-        self.force = [0, 0]
-
-    def step(self, delta_t):
-        self.velocity[0] += self.force[0]*delta_t/self.mass
-        self.velocity[1] += self.force[1]*delta_t/self.mass
+        self.force_x = 0
+        self.force_y = 0
 
-        self.position[0] += self.velocity[0]*delta_t
-        self.position[1] += self.velocity[1]*delta_t
+    def __getstate__(self):
+        return dict([[name, getattr(self, name)] \
+                for name in slot_names(type(self))])
 
-        if self.position[1] < 0:
-            self.position[0] -= self.velocity[0]*delta_t
-            self.position[1] -= self.velocity[1]*delta_t
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
-            self.velocity[0] -= self.velocity[0]*delta_t
-            self.velocity[1] -= self.velocity[1]*delta_t
+    @property
+    def force(self):
+        return [self.force_x, self.force_y]
 
-            counter_force = -(self.mass/delta_t) \
-                    * (self.position[1]/delta_t + self.velocity[1]) \
-                    - self.force[1]
+    def step(self, delta_t):
+        global ground_contacts
+        position = self.position
+        velocity = self.velocity
+        mass = self.mass
+        velocity_x = velocity[0] + self.force_x*delta_t/mass
+        velocity_y = velocity[1] + self.force_y*delta_t/mass
+
+        position_x = position[0] + velocity_x*delta_t
+        position_y = position[1] + velocity_y*delta_t
+
+        if position_y < 0:
+            ground_contacts += 1
+            position_x -= velocity_x*delta_t
+            position_y -= velocity_y*delta_t
+
+            velocity_x -= velocity_x*delta_t
+            velocity_y -= velocity_y*delta_t
+
+            counter_force = -(mass/delta_t) \
+                    * (position_y/delta_t + velocity_y) \
+                    - self.force_y
             friction = counter_force*FRICTION_COEFFICIENT
 
-            if self.velocity[0] < 0:
-                self.force[0] += friction
-                sign = -1
+            force_x = self.force_x
+            if velocity_x < 0:
+                force_x += friction
             else:
-                self.force[0] -= friction
-                sign = 1
-            self.force[1] += counter_force
+                force_x -= friction
+            force_y = self.force_y + counter_force
 
-            before = self.velocity[0]
-            self.velocity[0] += self.force[0]*delta_t/self.mass
-            if self.velocity[0] < 0 and before > 0:
-                self.velocity[0] = 0.0
-            elif self.velocity[0] > 0 and before < 0:
-                self.velocity[0] = 0.0
-            self.velocity[1] += self.force[1]*delta_t/self.mass
+            before = velocity_x
+            velocity_x += force_x*delta_t/mass
+            if velocity_x < 0 and before > 0:
+                velocity_x = 0.0
+            elif velocity_x > 0 and before < 0:
+                velocity_x = 0.0
+            velocity_y += force_y*delta_t/mass
 
-            self.position[0] += self.velocity[0]*delta_t
-            self.position[1] += self.velocity[1]*delta_t
+            position_x += velocity_x*delta_t
+            position_y += velocity_y*delta_t
 
-        self.velocity[0] *= (1-delta_t*DAMPING_COEFFICIENT)
-        self.velocity[1] *= (1-delta_t*DAMPING_COEFFICIENT)
+        position[0] = position_x
+        position[1] = position_y
+        velocity[0] = velocity_x*(1-delta_t*DAMPING_COEFFICIENT)
+        velocity[1] = velocity_y*(1-delta_t*DAMPING_COEFFICIENT)
 
-        self.force = [0, 0]
+        self.force_x = 0
+        self.force_y = 0
 
     def push(self, f):
-        self.force[0] += f[0]
-        self.force[1] += f[1]
+        self.force_x += f[0]
+        self.force_y += f[1]
 
     def get_color(self):
         return [255, 255, 255]
 
 class Cell(Body):
+    __slots__ = ["axial_stiffness", "bending_stiffness", "expansion",
+            "dissipation", "activation_rate", "transmittivity",
+            "contact_response", "voltage", "phase", "phase_time",
+            "connections", "delta_xs", "delta_ys", "angles", "distances"]
+
     def __init__(self, mass, position, axial_stiffness, bending_stiffness,
             expansion, dissipation, activation_rate, transmittivity, 
             contact_response):
@@ -82,6 +119,12 @@ class Cell(Body):
         self.phase_time = 0.0
         self.connections = [None, None, None, None]
 
+        # per-step geometry of the connections, reused between steps
+        self.delta_xs = [0.0]*4
+        self.delta_ys = [0.0]*4
+        self.angles = [0.0]*4
+        self.distances = [0.0]*4
+
     def connect(self, other, direction):
         self.connections[direction] = other
 
@@ -105,63 +148,62 @@ class Cell(Body):
             self.voltage -= self.activation_rate\
                 *(self.voltage/2+0.5)*delta_t
 
-        super(Cell, self).step(delta_t)
+        Body.step(self, delta_t)
 
     def interact(self, delta_t):
+        connections = self.connections
         if self.phase == 1:
-            for cell in self.connections:
+            for cell in connections:
                 if cell and cell.phase == 0:
-                    cell.charge(self.voltage*self.transmittivity*delta_t)
+                    cell.voltage += self.voltage*self.transmittivity*delta_t
 
         # relative positions of connected cells
-        delta_positions = [None, None, None, None]
-        angles = [None, None, None, None]
-        distances = [None, None, None, None]
+        x, y = self.position
+        delta_xs = self.delta_xs
+        delta_ys = self.delta_ys
+        angles = self.angles
+        distances = self.distances
         for i in xrange(4):
-            cell = self.connections[i]
+            cell = connections[i]
             if cell:
-                delta_x = cell.position[0] - self.position[0]
-                delta_y = cell.position[1] - self.position[1]
-                angle = math.atan2(delta_y, delta_x)
-                distance = (delta_x**2+delta_y**2)**0.5
-
-                delta_positions[i] = [delta_x, delta_y]
-                angles[i] = angle
-                distances[i] = distance
+                delta_x = cell.position[0] - x
+                delta_y = cell.position[1] - y
+                delta_xs[i] = delta_x
+                delta_ys[i] = delta_y
+                angles[i] = math.atan2(delta_y, delta_x)
+                distances[i] = (delta_x**2+delta_y**2)**0.5
 
         # radial forces to self
         for i in xrange(4):
-            cell = self.connections[i]
+            cell = connections[i]
             if cell:
-                delta_x = delta_positions[i][0]
-                delta_y = delta_positions[i][1]
                 distance = distances[i]
                 target = 2.0 + (self.expansion*self.voltage \
                         + cell.expansion*cell.voltage)/2
 
                 force = (self.axial_stiffness+cell.axial_stiffness)\
                         *(distance-target)/2
-                force_x = force*delta_x/distance
-                force_y = force*delta_y/distance
-                self.push([force_x, force_y])
+                self.force_x += force*delta_xs[i]/distance
+                self.force_y += force*delta_ys[i]/distance
 
         # torque on others
         for i in xrange(4):
-            cell = self.connections[i]
+            cell = connections[i]
             if cell:
                 angle_correction = 0
                 for j in xrange(4):
-                    if i != j and self.connections[j]:
-                        other = self.connections[j]
+                    if i != j and connections[j]:
                         angle_correction += ((angles[j]-angles[i]) \
-                                % (2*math.pi))
-                        angle_correction -= (math.pi*((j-i) % 4)/2)
-                force = self.bending_stiffness*angle_correction\
-                        /distances[i]
-                force_x = -force*delta_positions[i][1]/distances[i]
-                force_y = force*delta_positions[i][0]/distances[i]
-                self.connections[i].push([force_x, force_y])
-                self.push([-force_x, -force_y])
+                                % TWO_PI)
+                        angle_correction -= BEND_OFFSETS[(j-i) % 4]
+                distance = distances[i]
+                force = self.bending_stiffness*angle_correction/distance
+                force_x = -force*delta_ys[i]/distance
+                force_y = force*delta_xs[i]/distance
+                cell.force_x += force_x
+                cell.force_y += force_y
+                self.force_x -= force_x
+                self.force_y -= force_y
 
     def charge(self, c):
         self.voltage += c
@@ -209,24 +251,233 @@ class Cell(Body):
 
         return color
 
+# Cell.interact for all of an agent's cells at once. Each connection's
+# geometry is computed once per step and shared by both of its cells, and
+# bending angle differences are wrapped into [0, 2*pi) with comparisons
+# rather than a modulo. Charges and forces are applied cell by cell in the
+# same order as Cell.interact, so the results are identical to it.
+def interact_edges(cells, edges, bend_pairs, delta_t):
+    for a, slot, b, opposite in edges:
+        delta_x = b.position[0] - a.position[0]
+        delta_y = b.position[1] - a.position[1]
+        angle = math.atan2(delta_y, delta_x)
+        distance = (delta_x**2+delta_y**2)**0.5
+        a.delta_xs[slot] = delta_x
+        a.delta_ys[slot] = delta_y
+        a.angles[slot] = angle
+        a.distances[slot] = distance
+        # The reverse offset is subtracted rather than negated, keeping the
+        # sign of zero offsets which decides atan2's result for aligned
+        # cells, and its angle is not the forward one turned by pi, whose
+        # rounding chaotic gaits would soon amplify into different scores.
+        delta_x = a.position[0] - b.position[0]
+        delta_y = a.position[1] - b.position[1]
+        b.delta_xs[opposite] = delta_x
+        b.delta_ys[opposite] = delta_y
+        b.angles[opposite] = math.atan2(delta_y, delta_x)
+        b.distances[opposite] = distance
+
+    for self, pairs in zip(cells, bend_pairs):
+        connections = self.connections
+        if self.phase == 1:
+            for cell in connections:
+                if cell and cell.phase == 0:
+                    cell.voltage += self.voltage*self.transmittivity*delta_t
+
+        delta_xs = self.delta_xs
+        delta_ys = self.delta_ys
+        angles = self.angles
+        distances = self.distances
+        for i, _ in pairs:
+            cell = connections[i]
+            distance = distances[i]
+            target = 2.0 + (self.expansion*self.voltage \
+                    + cell.expansion*cell.voltage)/2
+            force = (self.axial_stiffness+cell.axial_stiffness)\
+                    *(distance-target)/2
+            self.force_x += force*delta_xs[i]/distance
+            self.force_y += force*delta_ys[i]/distance
+
+        for i, others in pairs:
+            angle_correction = 0
+            for j, offset in others:
+                # the same as % TWO_PI: atan2 returns both pi and -pi, so
+                # the difference can be exactly TWO_PI, which wraps to 0
+                difference = angles[j]-angles[i]
+                if difference < 0:
+                    difference += TWO_PI
+                elif difference >= TWO_PI:
+                    difference -= TWO_PI
+                angle_correction += difference
+                angle_correction -= offset
+            distance = distances[i]
+            force = self.bending_stiffness*angle_correction/distance
+            force_x = -force*delta_ys[i]/distance
+            force_y = force*delta_xs[i]/distance
+            cell = connections[i]
+            cell.force_x += force_x
+            cell.force_y += force_y
+            self.force_x -= force_x
+            self.force_y -= force_y
+
+def slot_names(cls):
+    names = []
+    for c in cls.__mro__:
+        names += getattr(c, "__slots__", [])
+    return names
+
 class World:
     def __init__(self, delta_t):
         self.delta_t = delta_t
         self.bodies = []
         self.agents = []
+        self.sleep_window = None
+        self.cell_steps = 0
+        self.skipped_cell_steps = 0
 
     def add_body(self, body):
         self.bodies.append(body)
+        self.neighbours = None
 
     def add_agent(self, agent):
         self.agents.append(agent)
         for b in agent.cells:
             self.add_body(b)
 
+    # Cells which stay still for window seconds, checked every
+    # check_interval seconds, are put to sleep: each connected group of
+    # them becomes an island, whose cells skip the voltage state machine
+    # and integration, keeping their positions and voltages. A cell is
+    # still while it is resting (phase 0), its speed, voltage and the force
+    # on it not balanced by the ground (including what friction can hold)
+    # are below speed, voltage and force. Awake neighbours still pull on
+    # and charge sleeping cells, and an island wakes as soon as one of its
+    # cells has a force or voltage above these thresholds. Pacemakers and
+    # cells whose contact response would fire never sleep.
+    def allow_sleeping(self, window, speed, force, voltage,
+            check_interval=0.1):
+        self.sleep_window = window
+        self.sleep_speed = speed
+        self.sleep_force = force
+        self.sleep_voltage = voltage
+        self.check_steps = max(1, int(round(check_interval/self.delta_t)))
+        self.window_checks = max(1, int(round(window/check_interval)))
+        self.neighbours = None
+
     def step(self):
         for b in self.bodies:
-            b.push([0, -g*b.mass])
+            b.force_y += -g*b.mass
         for a in self.agents:
             a.step(self.delta_t)
+        self.cell_steps += len(self.bodies)
+        if self.sleep_window == None:
+            for b in self.bodies:
+                b.step(self.delta_t)
+        else:
+            self.step_sleeping()
+
+    def build_islands(self):
+        index = dict([[id(b), k] for k, b in enumerate(self.bodies)])
+        pacemakers = set([id(a.pacemaker) for a in self.agents])
+        self.neighbours = []
+        self.can_sleep = []
         for b in self.bodies:
+            if isinstance(b, Cell):
+                self.neighbours.append([index[id(c)] \
+                        for c in b.connections if c])
+                self.can_sleep.append(id(b) not in pacemakers)
+            else:
+                self.neighbours.append([])
+                self.can_sleep.append(False)
+        self.quiet_checks = [0]*len(self.bodies)
+        self.asleep = [False]*len(self.bodies)
+        self.islands = []
+        self.awake = list(self.bodies)
+        self.sleep_step_count = 0
+
+    def unbalanced_force(self, b):
+        force_x = b.force_x
+        force_y = b.force_y
+        if b.position[1] < 0.001 and force_y < 0:
+            force_x = max(0.0, abs(force_x) + FRICTION_COEFFICIENT*force_y)
+            force_y = 0.0
+        return (force_x**2 + force_y**2)**0.5
+
+    def is_still(self, b):
+        return b.phase == 0 and abs(b.voltage) < self.sleep_voltage \
+                and (b.velocity[0]**2 + b.velocity[1]**2)**0.5 \
+                < self.sleep_speed \
+                and self.unbalanced_force(b) < self.sleep_force \
+                and not (b.contact_response and b.position[0] < 0.001)
+
+    def step_sleeping(self):
+        if self.neighbours == None:
+            self.build_islands()
+        bodies = self.bodies
+
+        changed = False
+        for island in self.islands:
+            for k in island:
+                b = bodies[k]
+                if abs(b.voltage) >= self.sleep_voltage \
+                        or self.unbalanced_force(b) >= self.sleep_force:
+                    for k in island:
+                        self.asleep[k] = False
+                        self.quiet_checks[k] = 0
+                    island[:] = []
+                    changed = True
+                    break
+            for k in island:
+                bodies[k].force_x = 0
+                bodies[k].force_y = 0
+        if changed:
+            self.islands = [island for island in self.islands if island]
+        self.skipped_cell_steps += sum([len(i) for i in self.islands])
+
+        self.sleep_step_count += 1
+        if self.sleep_step_count % self.check_steps == 0:
+            for k, b in enumerate(bodies):
+                if self.can_sleep[k] and not self.asleep[k]:
+                    if self.is_still(b):
+                        self.quiet_checks[k] += 1
+                    else:
+                        self.quiet_checks[k] = 0
+
+        if changed:
+            self.awake = [b for k, b in enumerate(bodies) \
+                    if not self.asleep[k]]
+        for b in self.awake:
             b.step(self.delta_t)
+
+        if self.sleep_step_count % self.check_steps == 0:
+            self.fall_asleep()
+
+    # groups the cells which have been still long enough into islands
+    def fall_asleep(self):
+        ready = set([k for k in xrange(len(self.bodies)) \
+                if not self.asleep[k] \
+                and self.quiet_checks[k] >= self.window_checks])
+        if len(ready) == 0:
+            return
+        while len(ready) > 0:
+            island = [ready.pop()]
+            for k in island:
+                for j in self.neighbours[k]:
+                    if j in ready:
+                        ready.remove(j)
+                        island.append(j)
+            for k in island:
+                self.asleep[k] = True
+                self.bodies[k].velocity[0] = 0.0
+                self.bodies[k].velocity[1] = 0.0
+            self.islands.append(island)
+        self.awake = [b for k, b in enumerate(self.bodies) \
+                if not self.asleep[k]]
+
+    def sleeping_fraction(self):
+        if self.cell_steps == 0:
+            return 0.0
+        return 1.0*self.skipped_cell_steps/self.cell_steps
+
+    def sync(self):
+        pass
@@ -0,0 +1,36 @@
+import pstats
+
+# Wall times and counts accumulated by name in this process. Scoring
+# processes send theirs back with each batch of results, see workers.
+totals = {}
+
+def add(name, value):
+    totals[name] = totals.get(name, 0) + value
+
+# Returns the totals accumulated since the last call, and starts afresh.
+def take():
+    global totals
+    taken = totals
+    totals = {}
+    return taken
+
+def merge(merged, other):
+    for name, value in other.iteritems():
+        merged[name] = merged.get(name, 0) + value
+    return merged
+
+# cProfile statistics as produced by Profile.create_stats, in a form
+# pstats.Stats can load, so statistics from several processes can be
+# combined with Stats.add.
+class ProfileData:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def merge_stats(merged, stats):
+    if merged == None:
+        return pstats.Stats(ProfileData(stats))
+    merged.add(pstats.Stats(ProfileData(stats)))
+    return merged
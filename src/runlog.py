@@ -0,0 +1,261 @@
+import os
+import Queue
+import struct
+import sys
+import threading
+import zlib
+
+import genefile
+
+# Append-only log of a run's populations, each logged once it has been
+# scored, with its scores. Each record holds one generation, either as a
+# full snapshot or as a delta against the previously logged generation, in
+# which genomes already present there are stored as the index they had.
+# Records carry a CRC, so a record cut short by a crash is detected on
+# opening and dropped, and the log resumes from the last complete one. The
+# log may also hold trajectory records, each a recording of the champion
+# from that generation on (see trajectory.py), for replaying it after the
+# run.
+#
+#   file:    magic, version, then records
+#   record:  generation (uint32), kind (uint8), payload length (uint32),
+#            CRC-32 of the payload (uint32), payload
+#   payload: rule_count (uint32), material_count, input_count (uint16),
+#            genome_count (uint32), then per genome either the index of
+#            the same genome in the previous record (int32), or -1
+#            followed by its length (uint32) and its genefile record,
+#            or for a trajectory record, the trajectory
+
+MAGIC = "CRLG"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")
+RECORD_HEADER = struct.Struct("<IBII")
+PAYLOAD_HEADER = struct.Struct("<IHHI")
+SNAPSHOT, DELTA, TRAJECTORY = 0, 1, 2
+
+class RunLog:
+    def __init__(self, file_name, snapshot_interval=10):
+        self.file_name = file_name
+        self.snapshot_interval = snapshot_interval
+        self.index = []
+        self.trajectories = []
+        if not os.path.isfile(file_name) or os.path.getsize(file_name) == 0:
+            f = open(file_name, "wb")
+            f.write(FILE_HEADER.pack(MAGIC, VERSION))
+            f.close()
+        self.scan()
+
+        self.previous = None
+        self.since_snapshot = 0
+        self.queue = Queue.Queue()
+        self.writer = None
+        self.error = None
+
+    # Reads the record headers, building an index of [generation, kind,
+    # offset, length] of the populations and one of [generation, offset,
+    # length] of the trajectories, and finding the end of the last valid
+    # record. Anything after it is only truncated once the log is appended
+    # to, so a log can be read while another process is writing it.
+    def scan(self):
+        f = open(self.file_name, "rb")
+        magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a run log" % self.file_name)
+        if version != VERSION:
+            raise ValueError("%s has unsupported version %d" \
+                    % (self.file_name, version))
+
+        end = FILE_HEADER.size
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            generation, kind, length, crc = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length \
+                    or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            if kind == DELTA and len(self.index) == 0:
+                break
+            if kind == TRAJECTORY:
+                self.trajectories.append([generation,
+                        end + RECORD_HEADER.size, length])
+            else:
+                self.index.append([generation, kind,
+                        end + RECORD_HEADER.size, length])
+            end += RECORD_HEADER.size + length
+        self.end = end
+        f.close()
+
+    def generations(self):
+        return [entry[0] for entry in self.index]
+
+    def last_generation(self):
+        if len(self.index) == 0:
+            return None
+        return self.index[-1][0]
+
+    # Rebuilds the population logged for generation, from the nearest
+    # snapshot at or before it.
+    def population(self, generation):
+        position = None
+        for i, entry in enumerate(self.index):
+            if entry[0] == generation:
+                position = i
+        if position == None:
+            raise KeyError("generation %d is not in %s" \
+                    % (generation, self.file_name))
+        start = position
+        while self.index[start][1] != SNAPSHOT:
+            start -= 1
+
+        f = open(self.file_name, "rb")
+        records = None
+        for _, kind, offset, length in self.index[start:position+1]:
+            f.seek(offset)
+            dimensions, records = read_payload(f.read(length), records)
+        f.close()
+        return [genefile.decode(record, 0, *dimensions) \
+                for record in records]
+
+    # Returns the trajectory of the champion of generation, the latest
+    # logged at or before it, or the latest of all if generation is None.
+    def trajectory(self, generation=None):
+        found = None
+        for entry in self.trajectories:
+            if generation == None or entry[0] <= generation:
+                found = entry
+        if found == None:
+            raise KeyError("no trajectory for generation %s in %s" \
+                    % (generation, self.file_name))
+        f = open(self.file_name, "rb")
+        f.seek(found[1])
+        data = f.read(found[2])
+        f.close()
+        return data
+
+    # Queues a generation to be written by the background writer. The
+    # genomes are encoded here, so the caller may change them afterwards.
+    def append(self, generation, genomes):
+        first = genomes[0]
+        dimensions = [first.rule_count, first.material_count,
+                first.input_count]
+        self.put([generation, SNAPSHOT, [dimensions,
+                [genefile.encode(genome) for genome in genomes]]])
+
+    # Queues the trajectory of the champion of generation, which is shown
+    # for later generations until another is logged.
+    def append_trajectory(self, generation, data):
+        self.put([generation, TRAJECTORY, data])
+
+    def put(self, item):
+        if self.error != None:
+            raise RuntimeError("run log writer failed: %s" % self.error)
+        if self.writer == None:
+            self.writer = threading.Thread(target=self.write)
+            self.writer.daemon = True
+            self.writer.start()
+        self.queue.put(item)
+
+    def write(self):
+        f = open(self.file_name, "r+b")
+        f.truncate(self.end)
+        f.seek(self.end)
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            generation, kind, content = item
+            try:
+                if kind == TRAJECTORY:
+                    self.write_trajectory(f, generation, content)
+                else:
+                    self.write_record(f, generation, *content)
+            except Exception as e:
+                self.error = e
+                break
+        f.close()
+
+    def write_record(self, f, generation, dimensions, records):
+        kind = DELTA
+        if self.previous == None or self.previous[0] != dimensions \
+                or self.since_snapshot + 1 >= self.snapshot_interval:
+            kind = SNAPSHOT
+            self.since_snapshot = 0
+        else:
+            self.since_snapshot += 1
+
+        previous_indices = {}
+        if kind == DELTA:
+            for i, record in enumerate(self.previous[1]):
+                previous_indices.setdefault(record, i)
+        parts = [PAYLOAD_HEADER.pack(dimensions[0], dimensions[1],
+                dimensions[2], len(records))]
+        for record in records:
+            if record in previous_indices:
+                parts.append(struct.pack("<i", previous_indices[record]))
+            else:
+                parts.append(struct.pack("<iI", -1, len(record)))
+                parts.append(record)
+        payload = "".join(parts)
+
+        offset = write_payload(f, generation, kind, payload)
+        self.index.append([generation, kind, offset, len(payload)])
+        self.previous = [dimensions, records]
+
+    def write_trajectory(self, f, generation, data):
+        offset = write_payload(f, generation, TRAJECTORY, data)
+        self.trajectories.append([generation, offset, len(data)])
+
+    # Waits for queued generations to be written.
+    def close(self):
+        if self.writer != None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.error != None:
+            raise RuntimeError("run log writer failed: %s" % self.error)
+
+# Writes a record, returning the offset of its payload.
+def write_payload(f, generation, kind, payload):
+    offset = f.tell() + RECORD_HEADER.size
+    f.write(RECORD_HEADER.pack(generation, kind, len(payload),
+            zlib.crc32(payload) & 0xffffffff))
+    f.write(payload)
+    f.flush()
+    os.fsync(f.fileno())
+    return offset
+
+def read_payload(payload, previous):
+    rule_count, material_count, input_count, genome_count \
+            = PAYLOAD_HEADER.unpack_from(payload, 0)
+    position = PAYLOAD_HEADER.size
+    records = []
+    for _ in xrange(genome_count):
+        source = struct.unpack_from("<i", payload, position)[0]
+        position += 4
+        if source >= 0:
+            records.append(previous[source])
+        else:
+            length = struct.unpack_from("<I", payload, position)[0]
+            position += 4
+            records.append(payload[position:position+length])
+            position += length
+    return [rule_count, material_count, input_count], records
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2:
+        log = RunLog(sys.argv[1])
+        entries = log.index + [[generation, TRAJECTORY, offset, length] \
+                for generation, offset, length in log.trajectories]
+        for generation, kind, _, length in sorted(entries,
+                key=lambda entry:entry[2]):
+            print "%d %s %d" % (generation, 
+                    ["snapshot", "delta", "trajectory"][kind], length)
+    elif len(sys.argv) in [4, 5]:
+        genomes = RunLog(sys.argv[1]).population(int(sys.argv[2]))
+        genefile.dump(genomes, *sys.argv[3:])
+    else:
+        print "usage: python -m src.runlog LOG [GENERATION DESTINATION " \
+                + "[binary|pickle]]"
+        sys.exit(1)
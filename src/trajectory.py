@@ -0,0 +1,174 @@
+import array
+import struct
+import sys
+import zlib
+
+from physics import Cell, EAST, NORTH
+
+# Recorded trajectories of an agent, for replaying without simulating it.
+# Frames are taken every frame_interval seconds of simulated time. Cell
+# positions are quantized to 1/POSITION_SCALE, well below a pixel at the
+# scale they are displayed, and stored as differences from the previous
+# frame, with the low and high bytes of the differences apart, which
+# compresses them best. Voltages only set a cell's color, which saturates
+# beyond 1 in magnitude, so they are quantized to 1/VOLTAGE_SCALE in a
+# byte. All values are little-endian.
+#
+#   header:     magic, version, cell_count, frame_count, frame_interval
+#   neighbours: east and north neighbour of each cell (int32, -1 if none)
+#   frames:     zlib-compressed x and y differences (int16 x 2*cell_count
+#               per frame), low bytes then high bytes, then voltages
+#               (int8 x cell_count per frame)
+
+MAGIC = "CRTJ"
+VERSION = 1
+HEADER = struct.Struct("<4sHIId")
+POSITION_SCALE = 100.0
+VOLTAGE_SCALE = 100.0
+
+def quantize(value, scale, limit):
+    if value != value:
+        return 0
+    return int(round(max(-limit, min(limit, value*scale))))
+
+def little_endian(a):
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+class Recorder:
+    def __init__(self, cells, frame_interval):
+        self.frame_interval = frame_interval
+        index = dict([[id(c), k] for k, c in enumerate(cells)])
+        self.neighbours = array.array("i")
+        for c in cells:
+            for direction in [EAST, NORTH]:
+                other = c.connections[direction]
+                self.neighbours.append(index[id(other)] if other else -1)
+        self.positions = array.array("h")
+        self.voltages = array.array("b")
+        self.previous = [0]*(2*len(cells))
+        self.frame_count = 0
+
+    def capture(self, cells):
+        positions = self.positions
+        previous = self.previous
+        k = 0
+        for c in cells:
+            for value in c.position:
+                # a difference too large for int16 is made up over the
+                # following frames
+                difference = quantize(value - previous[k]/POSITION_SCALE,
+                        POSITION_SCALE, 32767)
+                positions.append(difference)
+                previous[k] += difference
+                k += 1
+            self.voltages.append(quantize(c.voltage, VOLTAGE_SCALE, 127))
+        self.frame_count += 1
+
+    def encode(self):
+        positions = little_endian(self.positions[:]).tostring()
+        frames = positions[0::2] + positions[1::2] \
+                + self.voltages.tostring()
+        return HEADER.pack(MAGIC, VERSION, len(self.previous)/2,
+                self.frame_count, self.frame_interval) \
+                + little_endian(self.neighbours[:]).tostring() \
+                + zlib.compress(frames)
+
+class Trajectory:
+    def __init__(self, data):
+        magic, version, self.cell_count, self.frame_count, \
+                self.frame_interval = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a trajectory")
+        if version != VERSION:
+            raise ValueError("unsupported trajectory version %d" % version)
+        position = HEADER.size
+        self.neighbours = array.array("i")
+        self.neighbours.fromstring(data[position:position+8*self.cell_count])
+        little_endian(self.neighbours)
+        frames = zlib.decompress(data[position+8*self.cell_count:])
+        size = 2*self.cell_count*self.frame_count
+        interleaved = [None]*(2*size)
+        interleaved[0::2] = frames[:size]
+        interleaved[1::2] = frames[size:2*size]
+        self.positions = array.array("h")
+        self.positions.fromstring("".join(interleaved))
+        little_endian(self.positions)
+        self.voltages = array.array("b")
+        self.voltages.fromstring(frames[2*size:])
+
+    # [positions, voltages] of each frame, positions as [x, y] per cell
+    def frames(self):
+        n = self.cell_count
+        current = [0]*(2*n)
+        for f in xrange(self.frame_count):
+            deltas = self.positions[2*n*f:2*n*(f+1)]
+            for k in xrange(2*n):
+                current[k] += deltas[k]
+            positions = [[current[2*k]/POSITION_SCALE,
+                    current[2*k+1]/POSITION_SCALE] for k in xrange(n)]
+            voltages = [v/VOLTAGE_SCALE \
+                    for v in self.voltages[n*f:n*(f+1)]]
+            yield positions, voltages
+
+# Stands in for a World with one agent for Display, showing the frames of
+# a trajectory instead of simulating.
+class ReplayWorld:
+    def __init__(self, trajectory):
+        self.trajectory = trajectory
+        self.bodies = [Cell(1.0, [0.0, 0.0], 0, 0, 0, 0, 0, 0, False) \
+                for _ in xrange(trajectory.cell_count)]
+        for k, cell in enumerate(self.bodies):
+            for slot, direction in enumerate([EAST, NORTH]):
+                other = trajectory.neighbours[2*k+slot]
+                if other >= 0:
+                    cell.connect(self.bodies[other], direction)
+        self.agents = [ReplayAgent(self.bodies)]
+        self.frames = trajectory.frames()
+
+    # Moves to the next frame, from the start again after the last.
+    def step(self):
+        try:
+            positions, voltages = next(self.frames)
+        except StopIteration:
+            self.frames = self.trajectory.frames()
+            positions, voltages = next(self.frames)
+        for cell, position, voltage in zip(self.bodies, positions,
+                voltages):
+            cell.position = position
+            cell.voltage = voltage
+
+    def sync(self):
+        pass
+
+class ReplayAgent:
+    def __init__(self, cells):
+        self.cells = cells
+
+def is_trajectory(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def save(data, file_name):
+    f = open(file_name, "wb")
+    f.write(data)
+    f.close()
+
+def load(file_name):
+    f = open(file_name, "rb")
+    data = f.read()
+    f.close()
+    return data
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print "usage: python -m src.trajectory FILE|LOG [GENERATION]"
+        sys.exit(1)
+    import graphics
+    import runlog
+    if len(sys.argv) == 2 and is_trajectory(load(sys.argv[1])):
+        data = load(sys.argv[1])
+    else:
+        generation = int(sys.argv[2]) if len(sys.argv) == 3 else None
+        data = runlog.RunLog(sys.argv[1]).trajectory(generation)
+    graphics.play(Trajectory(data), 1200, 700)
@@ -0,0 +1,187 @@
+import cProfile
+import ctypes
+import math
+import multiprocessing
+import Queue
+import time
+import traceback
+
+import profiling
+
+# Long-lived scoring processes fed from a shared task queue. Each task is a
+# batch of items; a worker applies a function to the list of payloads and
+# returns one result per payload. Idle workers pull the next batch, so no
+# worker waits on a slow fixed share while work remains. Functions are
+# sent by name, so they must be defined at module level.
+#
+# Workers also send back the profiling totals their batches accumulated,
+# and, if profile is set, run each batch under cProfile and send its
+# statistics, which are merged across workers in profile_stats.
+#
+# While waiting for results, the pool checks every poll_interval seconds
+# that its processes are alive. One which died (killed, or crashed in
+# native code) took its batch with it and may have left the queues
+# unusable, so the others are terminated and map raises, as it does on any
+# later call.
+class ScoringPool:
+    def __init__(self, process_count, profile=False, poll_interval=1.0):
+        self.process_count = process_count
+        self.poll_interval = poll_interval
+        self.failure = None
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        for i in xrange(process_count):
+            process = multiprocessing.Process(target=work,
+                    args=(i, self.tasks, self.results, profile))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.profile_stats = None
+        self.reset_statistics()
+
+    # Busy, idle and queue wait times, and the workers' profiling totals,
+    # accumulate over calls to map until reset. profile_stats is never
+    # reset.
+    def reset_statistics(self):
+        self.busy_times = [0.0]*self.process_count
+        self.idle_times = [0.0]*self.process_count
+        self.wait_times = [0.0]*self.process_count
+        self.totals = [{} for _ in xrange(self.process_count)]
+        self.wall_time = 0.0
+
+    # items is a list of [key, payload]; returns a dict from key to the
+    # result of function for that payload. Batches shrink as the queue
+    # drains (guided self-scheduling) unless even is set, in which case
+    # each worker gets one equal share. If a batch raises, the other
+    # batches are still collected, so that none of their results are left
+    # for the next call, and then the first error is raised.
+    def map(self, function, items, even=False):
+        if self.failure != None:
+            raise RuntimeError(self.failure)
+        start = time.time()
+        batches = []
+        remaining = list(items)
+        while len(remaining) > 0:
+            if even:
+                size = int(math.ceil(1.0*len(items)/self.process_count))
+            else:
+                size = int(math.ceil(0.5*len(remaining)/self.process_count))
+            batches.append(remaining[:size])
+            remaining = remaining[size:]
+        for batch in batches:
+            self.tasks.put([function, batch, time.time()])
+
+        results = {}
+        failure = None
+        finish_times = [start]*self.process_count
+        for _ in xrange(len(batches)):
+            worker, batch_results, busy_time, error, wait_time, totals, \
+                    stats = self.receive()
+            if error != None and failure == None:
+                failure = "scoring process %d failed:\n%s" % (worker, error)
+            if error == None:
+                for key, result in batch_results:
+                    results[key] = result
+            self.busy_times[worker] += busy_time
+            self.wait_times[worker] += wait_time
+            profiling.merge(self.totals[worker], totals)
+            if stats != None:
+                self.profile_stats = profiling.merge_stats(
+                        self.profile_stats, stats)
+            finish_times[worker] = time.time()
+
+        end = time.time()
+        self.wall_time += end - start
+        for i in xrange(self.process_count):
+            self.idle_times[i] += end - finish_times[i]
+        if failure != None:
+            raise RuntimeError(failure)
+        return results
+
+    def receive(self):
+        while True:
+            try:
+                return self.results.get(True, self.poll_interval)
+            except Queue.Empty:
+                pass
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    self.failure = "scoring process %d exited with code %s" \
+                            % (i, process.exitcode)
+                    self.terminate()
+                    raise RuntimeError(self.failure)
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        # tasks nobody will read must not keep this process from exiting
+        self.tasks.cancel_join_thread()
+
+    def utilization(self):
+        if self.wall_time == 0:
+            return [0.0]*self.process_count
+        return [t/self.wall_time for t in self.busy_times]
+
+    # Any worker may take any None, so the live ones are counted first.
+    def close(self):
+        alive = [process for process in self.processes if process.is_alive()]
+        for _ in alive:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+# Genome records in shared memory, written by the main process and read by
+# the scoring processes, which inherit the buffers when they are started,
+# so it must be created before the ScoringPool. Each genome has a slot of
+# slot_size bytes and a score in a shared array of doubles.
+class SharedPopulation:
+    def __init__(self, capacity, slot_size):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.records = multiprocessing.RawArray("c", capacity*slot_size)
+        self.lengths = multiprocessing.RawArray("i", capacity)
+        self.scores = multiprocessing.RawArray("d", capacity)
+
+    def put(self, i, record):
+        if len(record) > self.slot_size:
+            raise ValueError("record of %d bytes exceeds slot of %d" \
+                    % (len(record), self.slot_size))
+        address = ctypes.addressof(self.records) + i*self.slot_size
+        ctypes.memmove(address, record, len(record))
+        self.lengths[i] = len(record)
+
+    def get(self, i):
+        address = ctypes.addressof(self.records) + i*self.slot_size
+        return ctypes.string_at(address, self.lengths[i])
+
+# Sends [worker, results, busy time, error, time the batch waited in the
+# queue, profiling totals, cProfile statistics or None] for each batch.
+def work(worker, tasks, results, profile=False):
+    while True:
+        task = tasks.get()
+        if task == None:
+            return
+        function, batch, sent = task
+        start = time.time()
+        profiler = cProfile.Profile() if profile else None
+        payloads = [payload for _, payload in batch]
+        try:
+            if profiler != None:
+                outputs = profiler.runcall(function, payloads)
+            else:
+                outputs = function(payloads)
+        except Exception:
+            results.put([worker, None, 0.0, traceback.format_exc(), 
+                    start - sent, profiling.take(), None])
+            continue
+        stats = None
+        if profiler != None:
+            profiler.create_stats()
+            stats = profiler.stats
+        batch_results = [[key, output] for (key, _), output \
+                in zip(batch, outputs)]
+        results.put([worker, batch_results, time.time() - start, None,
+                start - sent, profiling.take(), stats])